@@ -1,21 +1,30 @@
 import asyncio
 import logging
-from json import loads, JSONDecodeError
+from functools import partial
+from json import dumps
+from operator import attrgetter
 from pathlib import Path
-from time import sleep, time
-
-import busio
-import digitalio
-from adafruit_mcp230xx.mcp23008 import MCP23008
-
+from time import monotonic, time
+
+from backend import (ExpanderNotFoundError, configure_interrupts, get_backend,
+                     init_expander, read_interrupt)
+from bus_io import BusIOExecutor
+from commands import CommandDispatcher, CommandQueueFull
+from debounce import Debouncer
+from dispatch import BO_VALUE_SCHEMA, validate
+from encoding import get_encoder
+from metrics import serve_metrics
 from obj_type import ObjType
+from pulse import PulseScheduler
+from routing import MODE_INTERRUPT, RoutingTable
+from scheduler import AdaptiveInterval, BusStats, DeadlineTimer
+from state import StateStore
 
 _log = logging.getLogger(__name__)
+_base_dir = Path(__file__).resolve().parent
 
-try:
-    import board
-except NotImplementedError as e:
-    _log.critical(e)
+_get_gpio = attrgetter('gpio')
+_get_value = attrgetter('value')
 
 
 class I2CConnector:  # (Thread):
@@ -25,45 +34,182 @@ class I2CConnector:  # (Thread):
         # self.setDaemon(True)
 
         self.mqtt_client = visio_mqtt_client
+        self.metrics = self.mqtt_client.metrics
 
         self._config = config
-
-        self.i2c = busio.I2C(board.SCL, board.SDA)
+        self._buses = {**self._config.get('bo_buses', {}),
+                       **self._config.get('bi_buses', {})}
+
+        self.encoder = get_encoder(name=self.mqtt_client.encoding,
+                                   device_id=self.device_id)
+        # config compiled to per-pin records, used by all hot paths
+        self.routes = RoutingTable.compile(
+            device_id=self.device_id,
+            i2c_config=self._config,
+            publish_config=self.mqtt_client.publish_topics,
+            encoder=self.encoder
+        )
+
+        # last known states of the previous run (warm restart)
+        state_cfg = self._config.get('state') or {}
+        self.state = None
+        if state_cfg.get('path'):
+            self.state = StateStore(path=_base_dir / state_cfg['path'],
+                                    min_interval=state_cfg.get('save_interval', 1.0))
+            self.state.load()
+
+        # hardware or simulated expanders, see `backend` in i2c.yaml
+        self.backend = get_backend(config=self._config)
+
+        # all configured expanders must answer before anything is written
+        self._probe_expanders()
 
         # init i2c buses
-        self.bi_busses = [MCP23008(self.i2c, address=addr)
+        self.bi_busses = [self.backend.expander(address=addr)
                           for addr in self.bi_bus_ids]
 
-        self.bo_busses = [MCP23008(self.i2c, address=addr)
+        self.bo_busses = [self.backend.expander(address=addr)
                           for addr in self.bo_bus_ids]
         _log.debug(f'Buses: bo={self.bo_bus_ids} bi={self.bi_bus_ids}')
 
-        # init pins
-        self.bi_pins = {}
-        for bus, bus_addr in zip(self.bi_busses, self.bi_bus_ids):
-            pins = []
-            for i in range(8):
-                pin = bus.get_pin(i)
-                pin.direction = digitalio.Direction.INPUT
-                pin.pull = digitalio.Pull.UP
-                pins.append(pin)
+        # outputs start in their last commanded state, else all high
+        olat = {bo_bus_id: 0xFF for bo_bus_id in self.bo_bus_ids}
+        if self.state is not None:
+            olat.update((bus_id, port) for bus_id, port in self.state.outputs.items()
+                        if bus_id in olat)
 
-            self.bi_pins[bus_addr] = pins
-
-        self.bo_pins = {}
+        # init pins: whole registers once per expander instead of per pin
+        for bus in self.bi_busses:
+            # inputs with pull-ups, inversion is applied in software
+            init_expander(bus, iodir=0xFF, gppu=0xFF)
         for bus, bus_addr in zip(self.bo_busses, self.bo_bus_ids):
-            pins = []
-            for i in range(8):
-                pin = bus.get_pin(i)
-                pin.switch_to_output(value=True)
-                pins.append(pin)
-
-            self.bo_pins[bus_addr] = pins
+            init_expander(bus, iodir=0x00, gppu=0x00, olat=olat[bus_addr])
+
+        self.bi_pins = {bus_addr: [bus.get_pin(i) for i in range(8)]
+                        for bus, bus_addr in zip(self.bi_busses, self.bi_bus_ids)}
+        self.bo_pins = {bus_addr: [bus.get_pin(i) for i in range(8)]
+                        for bus, bus_addr in zip(self.bo_busses, self.bo_bus_ids)}
+        self._pins = {**self.bi_pins, **self.bo_pins}
+
+        # input filters of bi_buses with debounced pins
+        self.debouncers = {}  # bus_id: Debouncer
+        for bus in self.routes:
+            debouncer = Debouncer.for_bus(bus) if bus.bus_id in self.bi_bus_ids else None
+            if debouncer is not None:
+                self.debouncers[bus.bus_id] = debouncer
+
+        # INT lines of bi_buses in interrupt mode
+        self._interrupt_lines = {
+            bus.bus_id: self.backend.interrupt_line(address=bus.bus_id, pin=bus.int_pin)
+            for bus in self.routes if bus.mode == MODE_INTERRUPT
+        }
+
+        # blocking bus I/O is executed in a dedicated thread per bus
+        self.io = BusIOExecutor(timeout=self._config.get('transaction_timeout', 0.5),
+                                metrics=self.metrics)
+        for bus_id, bus_cfg in self.buses.items():
+            self.io.add_bus(bus_id=bus_id,
+                            timeout=(bus_cfg or {}).get('transaction_timeout'))
+
+        # RPC commands: tasks of the event loop, ordered per (bus_id, pin_id)
+        commands_cfg = self._config.get('commands', {})
+        self.commands = CommandDispatcher(
+            max_workers=commands_cfg.get('max_workers', 4),
+            max_queue_depth=commands_cfg.get('max_queue_depth', 8),
+            coalesce_window=commands_cfg.get('coalesce_window', 0.0),
+            metrics=self.metrics
+        )
+        # pending pulse reverts of all outputs
+        self.pulses = PulseScheduler()
 
         self._polling_buses = self.bi_bus_ids
-
-        self._last_values = {bi_bus_id: {i: None for i in range(8)}
-                             for bi_bus_id in self.bi_bus_ids}
+        self._polling_tasks = {}  # bus_id: asyncio.Task
+        self._publishing_tasks = {}  # bus_id: asyncio.Task
+        self._service_tasks = []  # reconcile, state saving, stats logging, metrics
+        self._loop = None
+        # how often polling tasks are checked against `_polling_buses`
+        self._supervise_interval = self._config.get('supervise_interval', 1)
+        # one INFO line of poll stats per bus per interval, 0 - disabled
+        self._log_summary_interval = self._config.get('log_summary_interval', 60)
+
+        self.bus_stats = {bi_bus_id: BusStats(bus_id=bi_bus_id)
+                          for bi_bus_id in self.bi_bus_ids}
+
+        self._bi_expanders = dict(zip(self.bi_bus_ids, self.bi_busses))
+        self._bo_expanders = dict(zip(self.bo_bus_ids, self.bo_busses))
+
+        # Shadow of output latches: port byte last written to each bo_bus.
+        self._olat = olat
+        # Levels pulse outputs revert to. The snapshot stores them instead of
+        # the active level, so a restart never leaves a pulse on.
+        self._pulse_mask = dict.fromkeys(self.bo_bus_ids, 0)
+        self._pulse_levels = dict.fromkeys(self.bo_bus_ids, 0)
+        # True - read back every written pin, else only periodic reconcile
+        self._verify_writes = self._config.get('verify_writes', False)
+        self._reconcile_interval = self._config.get('reconcile_interval', 10)
+        # last read GPIO port byte per bus (None - not read yet).
+        # With a state snapshot the first poll publishes only real changes.
+        self._last_ports = {bi_bus_id: None for bi_bus_id in self.bi_bus_ids}
+        if self.state is not None:
+            self._last_ports.update((bus_id, port)
+                                    for bus_id, port in self.state.inputs.items()
+                                    if bus_id in self._last_ports)
+        self._snapshot_seq = {}  # bus_id: sequence number of last snapshot
+
+        # local Prometheus endpoint, no port - disabled
+        self._metrics_cfg = self._config.get('metrics') or {}
+        self._cycle_time = self.metrics.histogram(
+            'panel_poll_cycle_seconds', 'Poll cycle duration', labels=('bus',))
+        self._poll_jitter = self.metrics.histogram(
+            'panel_poll_jitter_seconds', 'Poll start after its deadline', labels=('bus',))
+        self._confirm_time = self.metrics.histogram(
+            'panel_command_confirm_seconds', 'Command receipt to confirmation publish',
+            labels=('method',))
+        self.metrics.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        """Copies counters kept by stats, timers, debouncers and pulses into metrics."""
+        m = self.metrics
+        cycles = m.counter('panel_poll_cycles_total', 'Poll cycles', labels=('bus',))
+        missed = m.counter('panel_poll_missed_deadlines_total',
+                           'Poll cycles longer than the interval', labels=('bus',))
+        skipped = m.counter('panel_poll_skipped_deadlines_total',
+                            'Poll deadlines dropped by the skip policy', labels=('bus',))
+        interval = m.gauge('panel_poll_interval_seconds', 'Current poll interval',
+                           labels=('bus',))
+        for bus_id, stats in list(self.bus_stats.items()):
+            cycles.labels(bus_id).set(stats.cycles)
+            missed.labels(bus_id).set(stats.missed_deadlines)
+            interval.labels(bus_id).set(stats.interval or 0.0)
+            if stats.timer is not None:
+                skipped.labels(bus_id).set(stats.timer.skipped)
+
+        suppressed = m.counter('panel_debounce_suppressed_total',
+                               'Input changes suppressed by debouncing',
+                               labels=('bus', 'pin'))
+        for bus_id, debouncer in self.debouncers.items():
+            for pin_id, count in enumerate(debouncer.suppressed):
+                suppressed.labels(bus_id, pin_id).set(count)
+
+        m.gauge('panel_pulses_pending', 'Scheduled pulse reverts').set(len(self.pulses))
+        m.gauge('panel_pulse_max_lateness_seconds',
+                'Latest pulse revert after its deadline').set(self.pulses.max_lateness)
+        if self.state is not None:
+            m.counter('panel_state_saves_total', 'State snapshot writes'
+                      ).labels().set(self.state.saves)
+
+    def _probe_expanders(self):
+        """Scans the bus once and fails with a report of all missing expanders."""
+        present = set(self.backend.scan())
+        missing = [f'{bus_id} ({bus_id:#04x}) in {section}'
+                   for section, bus_ids in (('bi_buses', self.bi_bus_ids),
+                                            ('bo_buses', self.bo_bus_ids))
+                   for bus_id in bus_ids if bus_id not in present]
+        if missing:
+            found = ' '.join(f'{address:#04x}' for address in sorted(present)) or 'none'
+            raise ExpanderNotFoundError(f'I2C expanders not found: {", ".join(missing)}. '
+                                        f'Answering addresses: {found}')
+        _log.debug(f'All expanders answer: bo={self.bo_bus_ids} bi={self.bi_bus_ids}')
 
     @property
     def bi_bus_ids(self):
@@ -75,7 +221,7 @@ class I2CConnector:  # (Thread):
 
     @property
     def buses(self):
-        return {**self._config.get('bo_buses', {}), **self._config.get('bi_buses', {})}
+        return self._buses
 
     @classmethod
     def from_yaml(cls, visio_mqtt_client, yaml_path: Path):
@@ -93,226 +239,669 @@ class I2CConnector:  # (Thread):
 
     @property
     def pins(self):  # -> dict[int, list]:
-        return {**self.bi_pins, **self.bo_pins}
+        return self._pins
 
     @property
     def device_id(self):  # -> int
         return self.mqtt_client.device_id
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None):
         # topic: str, payload: str = None, qos: int = 0,
-        # retain: bool = True) -> mqtt.MQTTMessageInfo:
+        # retain: bool = True, key: str = None) -> mqtt.MQTTMessageInfo:
+        """:param key: state identity, only the latest publish per key is kept
+        while the broker is unreachable
+        """
+        if topic is None:  # no topic configured for the pin
+            return None
         return self.mqtt_client.publish(topic=topic,
                                         payload=payload,
                                         qos=qos,
-                                        retain=retain
+                                        retain=retain,
+                                        key=key
                                         )
 
-    @staticmethod
-    def decode(msg):  # mqtt.MQTTMessage):
+    async def run(self) -> None:
+        """Polling until cancelled, in the event loop of the MQTT client."""
         try:
-            if isinstance(msg.payload, bytes):
-                content = loads(msg.payload.decode("utf-8", "ignore"))
-            else:
-                content = loads(msg.payload)
-        except JSONDecodeError:
-            if isinstance(msg.payload, bytes):
-                content = msg.payload.decode("utf-8", "ignore")
-            else:
-                content = msg.payload
-        return content
-
-    def run(self) -> None:
-        asyncio.run(self.start_polling())
+            await self.start_polling()
+        finally:
+            # tasks use the bus workers, so they are stopped first
+            tasks = [*self._service_tasks, *self._polling_tasks.values(),
+                     *self._publishing_tasks.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.io.shutdown()
+            self.commands.shutdown()
+            self.pulses.stop()
+            if self.state is not None and self.state.dirty:
+                self.state.save()
 
     async def start_polling(self):
+        """Runs every bus from `_polling_buses` in its own task.
+        Buses added to or removed from `_polling_buses` at runtime are picked up.
+        """
         _log.info(f'Start polling: {self._polling_buses}')
+        self._loop = asyncio.get_running_loop()
+
+        services = []
+        if self.bo_bus_ids and not self._verify_writes:
+            services.append((self.start_reconcile(), 'Outputs-reconcile'))
+        if self.state is not None:
+            services.append((self.start_state_saving(), 'State-saving'))
+        if self._log_summary_interval:
+            services.append((self.start_stats_logging(), 'Stats-logging'))
+        if self._metrics_cfg.get('port'):
+            services.append((serve_metrics(self.metrics,
+                                           host=self._metrics_cfg.get('host', '127.0.0.1'),
+                                           port=self._metrics_cfg['port']),
+                             'Metrics-server'))
+        self._service_tasks = [asyncio.create_task(coro, name=name)
+                               for coro, name in services]
+
+        while True:
+            self._sync_polling_tasks()
+            await asyncio.sleep(self._supervise_interval)
+
+    def _sync_polling_tasks(self):
+        """Starts tasks for new (or crashed) buses, cancels tasks of removed buses.
+        Every bus has a polling task and, if `mqtt_interval` is set, a periodic
+        publishing task.
+        """
+        for bus_id in list(self._polling_buses):
+            self.bus_stats.setdefault(bus_id, BusStats(bus_id=bus_id))
+            self._last_ports.setdefault(bus_id, None)
+            mqtt_interval = self.get_mqtt_interval(bus_id=bus_id)
+
+            if self._task_is_running(tasks=self._polling_tasks, bus_id=bus_id):
+                pass
+            elif bus_id in self._interrupt_lines:
+                self._polling_tasks[bus_id] = asyncio.create_task(
+                    self.start_bus_interrupts(
+                        bus_id=bus_id,
+                        safety_interval=self.routes.bus(bus_id).safety_interval
+                    ),
+                    name=f'Bus-{bus_id}-polling')
+                _log.debug(f'Bus: {bus_id} interrupt polling started')
+            else:
+                self._polling_tasks[bus_id] = asyncio.create_task(
+                    self.start_bus_polling(
+                        bus_id=bus_id,
+                        realtime_interval=self.get_realtime_interval(bus_id=bus_id),
+                        start_time=monotonic()
+                    ),
+                    name=f'Bus-{bus_id}-polling')
+                _log.debug(f'Bus: {bus_id} polling started')
+
+            if (mqtt_interval is not None
+                    and not self._task_is_running(tasks=self._publishing_tasks,
+                                                  bus_id=bus_id)):
+                self._publishing_tasks[bus_id] = asyncio.create_task(
+                    self.start_bus_publishing(bus_id=bus_id,
+                                              mqtt_interval=mqtt_interval,
+                                              start_time=monotonic()),
+                    name=f'Bus-{bus_id}-publishing')
+                _log.debug(f'Bus: {bus_id} periodic publishing started')
+
+        for name, tasks in (('polling', self._polling_tasks),
+                            ('publishing', self._publishing_tasks)):
+            for bus_id in list(tasks):
+                if bus_id not in self._polling_buses:
+                    tasks.pop(bus_id).cancel()
+                    _log.debug(f'Bus: {bus_id} {name} stopped')
 
-        for bus_id in self._polling_buses:
-            await asyncio.ensure_future(
-                self.start_bus_polling(
-                    bus_id=bus_id,
-                    realtime_interval=self.get_realtime_interval(bus_id=bus_id),
-                    mqtt_interval=self.get_mqtt_interval(bus_id=bus_id),
-                    start_time=time()
-                ))
-
-    async def start_bus_polling(self, bus_id,
-                                realtime_interval, mqtt_interval,
-                                start_time) -> None:
-
-        start_time_expired = False
+    @staticmethod
+    def _task_is_running(tasks, bus_id):  # -> bool
+        task = tasks.get(bus_id)
+        if task is None:
+            return False
+        if not task.done():
+            return True
+        if not task.cancelled() and task.exception():
+            _log.error(f'Bus: {bus_id} task {task.get_name()} failed. Restarting ...',
+                       exc_info=task.exception()
+                       )
+        return False
+
+    async def start_reconcile(self):
+        """Periodically compares output ports with the latch shadow
+        and restores the shadow state if they differ.
+        """
+        while True:
+            await asyncio.sleep(self._reconcile_interval)
+            for bus_id, expander in self._bo_expanders.items():
+                try:
+                    port = await self.io[bus_id].read(_get_gpio, expander)
+                    if port != self._olat[bus_id]:
+                        _log.warning(f'Bus: {bus_id} outputs {port:#010b} differ from '
+                                     f'written {self._olat[bus_id]:#010b}. Restoring ...')
+                        await self.io[bus_id].write(self._write_port, bus_id,
+                                                    self._olat[bus_id])
+                except OSError as e:
+                    _log.warning(f'Bus: {bus_id} reconcile error: {e}')
+
+    async def start_stats_logging(self):
+        """Logs poll stats of every bus once per `log_summary_interval`."""
+        t0 = monotonic()
+        while True:
+            await asyncio.sleep(self._log_summary_interval)
+            now = monotonic()
+            if _log.isEnabledFor(logging.INFO):
+                for stats in list(self.bus_stats.values()):
+                    _log.info(stats.summary(period=now - t0))
+            t0 = now
+
+    async def start_state_saving(self):
+        """Writes the state snapshot when it changed, at most once per `min_interval`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.state.min_interval)
+            if self.state.due():
+                await loop.run_in_executor(None, self.state.save)
+
+    def add_polling_bus(self, bus_id):
+        # bus_id: int) -> None:
+        if bus_id not in self.bi_pins:
+            raise ValueError(f'Bus {bus_id} is not configured as bi_bus')
+        if bus_id not in self._polling_buses:
+            self._polling_buses.append(bus_id)
+            self._resync()
+
+    def remove_polling_bus(self, bus_id):
+        # bus_id: int) -> None:
+        if bus_id in self._polling_buses:
+            self._polling_buses.remove(bus_id)
+            self._resync()
+
+    def _resync(self):
+        """Applies `_polling_buses` changes without waiting for the supervisor."""
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._sync_polling_tasks)
+
+    async def start_bus_polling(self, bus_id, realtime_interval, start_time) -> None:
+        """Polls the bus on deadlines of `realtime_interval` from `start_time`
+        (monotonic clock) and publishes changes.
+        """
+        bus = self.routes.bus(bus_id)
+        interval = AdaptiveInterval(floor=realtime_interval,
+                                    ceiling=bus.max_interval,
+                                    backoff=bus.backoff)
+        poll_timer = DeadlineTimer(interval=realtime_interval,
+                                   policy=bus.deadline_policy,
+                                   start=start_time)
+        self.bus_stats[bus_id].timer = poll_timer
+        cycle_time = self._cycle_time.labels(bus_id)
+        poll_jitter = self._poll_jitter.labels(bus_id)
         while bus_id in self._polling_buses:
-            _t0 = time()
-            for pin_id in range(len(self.bi_pins[bus_id])):
-                rvalue = self.read_i2c(bus_id=bus_id, pin_id=pin_id)
-
-                # if rvalue != self.get_default(bus_id=bus_id, pin_id=pin_id):
-                #     _log.debug('Non-default value - pub')
-                #     topic = self.get_topic(bus_id=bus_id, pin_id=pin_id)
-                #     payload = '{0} {1} {2} {3}'.format(self.device_id,
-                #                                        ObjType.BINARY_INPUT.id,
-                #                                        f'{bus_id}0{pin_id}',
-                #                                        int(rvalue),
-                #                                        )
-                #     self.publish(topic=topic, payload=payload,
-                #                  qos=1, retain=True)
-
-                if rvalue != self._last_values[bus_id][pin_id]:
-                    self._last_values[bus_id][pin_id] = rvalue
-                    _log.debug('Not equal last value - pub')
-
-                    topic = self.get_topic(bus_id=bus_id, pin_id=pin_id)
-                    payload = '{0} {1} {2} {3}'.format(self.device_id,
-                                                       ObjType.BINARY_INPUT.id,
-                                                       f'{bus_id}0{pin_id}',
-                                                       int(rvalue),
-                                                       )
-                    self.publish(topic=topic, payload=payload,
-                                 qos=1, retain=True)
-
-                elif (time() - start_time) >= mqtt_interval:
-                    start_time_expired = True
-                    _log.debug('Default value. Expired interval - pub')
-                    topic = self.get_topic(bus_id=bus_id, pin_id=pin_id)
-                    payload = '{0} {1} {2} {3}'.format(self.device_id,
-                                                       ObjType.BINARY_INPUT.id,
-                                                       f'{bus_id}0{pin_id}',
-                                                       int(rvalue),
-                                                       )
-                    self.publish(topic=topic, payload=payload,
-                                 qos=0, retain=False)
-            if start_time_expired:
-                start_time += mqtt_interval
-                # start_time_expired = False # TODO: for start sending poll?
-
-            _t_delta = time() - _t0
-            delay = (realtime_interval - _t_delta) * 0.9
-            _log.info(f'Bus: {bus_id} polled for {round(_t_delta, ndigits=3)} sec '
-                      f'sleeping {delay} sec ...')
-            await asyncio.sleep(delay)
+            poll_jitter.observe(await poll_timer.wait())
+            _t0 = monotonic()
+            port = await self.read_bus(bus_id=bus_id)
+            last_port = self._last_ports[bus_id]
+            debouncer = self.debouncers.get(bus_id)
+            if port is not None and debouncer is not None:
+                port = debouncer.update(port=port, now=monotonic())
+            # poll faster while inputs of the bus are changing
+            realtime_interval = interval.update(
+                changed=(port is not None and last_port is not None and port != last_port
+                         or debouncer is not None and debouncer.pending))
+            if port is not None:
+                self._publish_port(bus=bus, port=port)
+
+            _t_delta = monotonic() - _t0
+            self.bus_stats[bus_id].record(cycle_time=_t_delta,
+                                          interval=realtime_interval)
+            cycle_time.observe(_t_delta)
+            poll_timer.advance(interval=realtime_interval)
+
+    async def start_bus_interrupts(self, bus_id, safety_interval) -> None:
+        """Waits for the INT line of the expander instead of polling.
+
+        INTF/INTCAP give the pins which caused the interrupt and their levels
+        latched at that moment, so pulses shorter than a poll interval are
+        published too. GPIO is read after every interrupt (which also clears it)
+        and every `safety_interval` in case an edge is lost.
+        """
+        bus = self.routes.bus(bus_id)
+        expander = self._bi_expanders[bus_id]
+        line = self._interrupt_lines[bus_id]
+        debouncer = self.debouncers.get(bus_id)
+        # resample period while a debounced change is not confirmed yet
+        resample_interval = bus.realtime_interval or 0.01
+        loop = asyncio.get_running_loop()
+        interrupted = asyncio.Event()
+        cycle_time = self._cycle_time.labels(bus_id)
+
+        def on_interrupt():
+            # called from the GPIO (or simulator) thread
+            loop.call_soon_threadsafe(interrupted.set)
+
+        line.add_callback(on_interrupt)
+        try:
+            await self.io[bus_id].write(configure_interrupts, expander)
+            _log.info(f'Bus: {bus_id} interrupts enabled on {line}')
+            while bus_id in self._polling_buses:
+                _t0 = monotonic()
+                interrupted.clear()
+                try:
+                    intf, intcap = await self.io[bus_id].read(read_interrupt, expander)
+                except OSError as e:
+                    _log.warning(f'Bus: {bus_id} interrupt read error: {e}')
+                    intf = 0
+                last_port = self._last_ports[bus_id]
+                # latched glitches are exactly what a debouncer filters out
+                if intf and last_port is not None and debouncer is None:
+                    # levels at the moment of interrupt, other pins are unchanged
+                    self._publish_port(bus=bus,
+                                       port=(last_port & ~intf) | (intcap & intf))
+
+                port = await self.read_bus(bus_id=bus_id)
+                if port is not None:
+                    if debouncer is not None:
+                        port = debouncer.update(port=port, now=monotonic())
+                    self._publish_port(bus=bus, port=port)
+
+                _t_delta = monotonic() - _t0
+                self.bus_stats[bus_id].record(cycle_time=_t_delta,
+                                              interval=safety_interval)
+                cycle_time.observe(_t_delta)
+                timeout = safety_interval
+                if debouncer is not None and debouncer.pending:
+                    timeout = resample_interval
+                if _log.isEnabledFor(logging.DEBUG):
+                    _log.debug(f'Bus: {bus_id} read for {round(_t_delta, ndigits=3)} sec '
+                               f'(INTF={intf:#010b}) waiting for interrupt ...')
+                try:
+                    await asyncio.wait_for(interrupted.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            line.remove_callback(on_interrupt)
+
+    async def start_bus_publishing(self, bus_id, mqtt_interval, start_time,
+                                   clock=monotonic, sleep=asyncio.sleep) -> None:
+        """Publishes states of all pins of the bus once per `mqtt_interval`.
+
+        States come from the last port read by the polling task, so periodic
+        publishes do not touch the bus. Missed intervals are skipped, not repeated.
+
+        :param clock: monotonic clock, `start_time` is on it
+        :param sleep: coroutine sleeping on `clock`
+        """
+        bus = self.routes.bus(bus_id)
+        timer = DeadlineTimer(interval=mqtt_interval,
+                              policy=DeadlineTimer.SKIP,
+                              start=start_time + mqtt_interval,
+                              clock=clock, sleep=sleep)
+        while bus_id in self._polling_buses:
+            await timer.wait()
+            self._publish_periodic(bus=bus)
+            timer.advance()
+
+    def _publish_port(self, bus, port):
+        # bus: BusRecord, port: int) -> None:
+        """Publishes pins whose bit differs from the previous port byte."""
+        last_port = self._last_ports[bus.bus_id]
+        # only pins whose bit differs from the previous port byte
+        changed = 0xFF if last_port is None else port ^ last_port
+        self._last_ports[bus.bus_id] = port
+        if not changed:
+            return
+        if self.state is not None:
+            self.state.set_input(bus_id=bus.bus_id, port=port)
+
+        # bit=1 means True (pin value with inversion applied)
+        states = port ^ bus.invert_mask
+        for pin in bus.pins:
+            if changed & pin.mask:
+                self.publish(topic=pin.topic,
+                             payload=pin.payloads[states >> pin.pin_id & 1],
+                             qos=1, retain=True, key=pin.obj_id)
+
+    def _publish_periodic(self, bus):
+        # bus: BusRecord) -> None:
+        """Publishes states of all pins (or the bus snapshot) from the last read port."""
+        port = self._last_ports.get(bus.bus_id)
+        if port is None:
+            _log.debug(f'Bus: {bus.bus_id} not read yet, periodic publish skipped')
+            return
+        states = port ^ bus.invert_mask
+        if bus.snapshot:
+            self._publish_snapshot(bus=bus, states=states)
+            return
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Bus: {bus.bus_id} expired interval - pub')
+        for pin in bus.pins:
+            self.publish(topic=pin.topic,
+                         payload=pin.payloads[states >> pin.pin_id & 1],
+                         qos=0, retain=False, key=pin.obj_id)
+
+    def _publish_snapshot(self, bus, states):
+        # bus: BusRecord, states: int) -> None:
+        seq = self._snapshot_seq.get(bus.bus_id, 0) + 1
+        self._snapshot_seq[bus.bus_id] = seq
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Bus: {bus.bus_id} expired interval - pub snapshot {seq}')
+        self.publish(topic=bus.topic,
+                     payload=self.encoder.encode_snapshot(bus=bus, states=states,
+                                                          timestamp=time(), seq=seq),
+                     qos=0, retain=False, key=f'bus:{bus.bus_id}')
 
     def get_topic(self, bus_id, pin_id):  # -> str:
-        topic = self.mqtt_client.publish_topics[bus_id]['pin_topic'].get(pin_id)
-        if topic is None:
-            topic = self.mqtt_client.publish_topics[bus_id]['bus_topic']
-        return topic
+        return self.routes.pin(bus_id=bus_id, pin_id=pin_id).topic
 
     def get_default(self, bus_id, pin_id):  # -> bool
-        default_value = self.buses[bus_id]['default'].get(pin_id)
-        if default_value is None:
-            default_value = self.buses[bus_id]['default']['bus']
-        return default_value
+        return self.routes.pin(bus_id=bus_id, pin_id=pin_id).default
 
     def get_mqtt_interval(self, bus_id):  # -> int:
-        return self.mqtt_client.bus_intervals[bus_id]
+        return self.routes.bus(bus_id=bus_id).mqtt_interval
 
     def get_realtime_interval(self, bus_id):  # -> float
-        return self._config['bi_buses'][bus_id]['realtime_interval']
+        return self.routes.bus(bus_id=bus_id).realtime_interval
 
     def get_pulse_delay(self, bus_id, pin_id):
-        return self._config['bo_buses'][bus_id]['pulse_delay'][pin_id]
-
-    def rpc_value_panel(self, params):
-        # params: dict) -> None:
-
-        # todo: validate params
+        return self.routes.pin(bus_id=bus_id, pin_id=pin_id).pulse_delay
 
-        _log.debug(f'Processing \'value\' method with params: {params}')
-
-        obj_id = params['object_identifier']
+    @staticmethod
+    def parse_obj_id(obj_id):  # -> tuple[int, int]:
         # first two numbers in object_id contains bus address.
         # Then going pin number.
         # Example: obj_id=3701 -> bus_address=37, pin=01
         bus_id = int(str(obj_id)[:2])
         pin_id = int(str(obj_id)[2:])
+        return bus_id, pin_id
+
+    def publish_error(self, method, params, message):
+        # method: str, params: dict, message: str) -> None:
+        payload = dumps({'method': method,
+                         'params': params,
+                         'error': {'message': message},
+                         })
+        self.publish(topic=self.mqtt_client.error_topic, payload=payload,
+                     qos=1, retain=False)
+
+    def submit_rpc_value(self, params):
+        # params: dict) -> None:
+        """Queues 'value' command. Rejects it with an error publish
+        when the pin already has too many pending commands.
+        Only the latest command per pin within `coalesce_window` is executed.
+        Binary-output writes require 'value', binary-input reads have none.
+        """
+        try:
+            if params['object_type'] == ObjType.BINARY_OUTPUT.id:
+                validate(params, BO_VALUE_SCHEMA)
+            key = self.parse_obj_id(obj_id=params['object_identifier'])
+            seq = self.commands.submit(key, self.rpc_value_panel, coalesce=True,
+                                       params=params, received_at=monotonic())
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f'Accepted \'value\' command {seq} for {key}')
+        except (LookupError, ValueError) as e:
+            _log.warning(f'Invalid \'value\' params {params}: {e}')
+            self.publish_error(method='value', params=params,
+                               message=f'Invalid params: {e}')
+        except CommandQueueFull as e:
+            _log.warning(f'Rejected \'value\' command: {e}')
+            self.publish_error(method='value', params=params, message=str(e))
+
+    def submit_rpc_values(self, params):
+        # params: dict) -> None:
+        """Queues 'values' command: list of binary-output values.
+        Entries are grouped by bus, every bus is written as one port byte.
+
+        Params example:
+            {"device_id": 666,
+             "values": [{"object_type": 4, "object_identifier": 3501, "value": 1},
+                        {"object_type": 4, "object_identifier": 3502, "value": 0}]}
+        """
+        received_at = monotonic()
+        try:
+            by_bus = {}
+            for entry in params['values']:
+                if entry['object_type'] != ObjType.BINARY_OUTPUT.id:
+                    raise ValueError(f'Expected only {ObjType.BINARY_OUTPUT}')
+                bus_id, pin_id = self.parse_obj_id(obj_id=entry['object_identifier'])
+                if bus_id not in self._bo_expanders or not 0 <= pin_id <= 7:
+                    raise ValueError(f'Unknown output {entry["object_identifier"]}')
+                by_bus.setdefault(bus_id, {})[pin_id] = bool(entry['value'])
+        except (LookupError, TypeError, ValueError) as e:
+            _log.warning(f'Invalid \'values\' params {params}: {e}')
+            self.publish_error(method='values', params=params,
+                               message=f'Invalid params: {e}')
+            return
+
+        for bus_id, values in by_bus.items():
+            try:
+                # ordered with other commands of every pin it writes
+                self.commands.submit([(bus_id, pin_id) for pin_id in sorted(values)],
+                                     self.rpc_values_bus,
+                                     bus_id=bus_id, values=values,
+                                     received_at=received_at)
+            except CommandQueueFull as e:
+                _log.warning(f'Rejected \'values\' command: {e}')
+                self.publish_error(method='values', params=params, message=str(e))
+
+    async def rpc_values_bus(self, bus_id, values, received_at=None):
+        # bus_id: int, values: dict[int, bool], received_at: float = None
+        # ) -> Optional[Callable[[], None]]:
+        """Applies values of several pins of one bo_bus in a single port write.
+
+        :return: one confirmation for the bus, published in command order
+        """
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Processing \'values\' method for bus {bus_id}: {values}')
+
+        bus = self.routes.bus(bus_id)
+        values = {pin_id: value for pin_id, value in values.items()
+                  if value != bus.pins[pin_id].default}
+        if not values:
+            _log.debug('Received default values only')
+            return
+
+        mask = levels = pulse_mask = 0
+        for pin_id, value in values.items():
+            pin = bus.pins[pin_id]
+            mask |= pin.mask
+            if value != pin.inverted:
+                levels |= pin.mask
+            if pin.pulse_delay:
+                pulse_mask |= pin.mask
+        # pulses revert to the opposite level
+        self._set_pulse_rest(bus_id=bus_id, mask=pulse_mask, levels=~levels)
+
+        try:
+            await self.io[bus_id].write(self._write_port_bits, bus_id, mask, levels)
+            if self._verify_writes:
+                port = await self.io[bus_id].read(_get_gpio, self._bo_expanders[bus_id])
+                if port & mask != levels:
+                    _log.warning(f'Bus: {bus_id} write check failed: '
+                                 f'{port & mask:#010b} != {levels:#010b}')
+                    return
+        except OSError as e:
+            _log.warning(f'Bus: {bus_id} write error: {e}')
+            return
+
+        for pin_id, value in values.items():
+            key = (bus_id, pin_id)
+            delay = bus.pins[pin_id].pulse_delay
+            if delay:
+                self.pulses.schedule(key=key, delay=delay, fn=self._submit_pulse_revert,
+                                     value=not value, bus_id=bus_id, pin_id=pin_id)
+            else:
+                self.pulses.cancel(key=key)
+
+        payload = self.encoder.encode_batch((bus.pins[pin_id], value)
+                                            for pin_id, value in sorted(values.items()))
+        return partial(self._publish_confirmation, method='values', topic=bus.topic,
+                       payload=payload, key=None, received_at=received_at)
+
+    async def rpc_value_panel(self, params, received_at=None):
+        # params: dict, received_at: float = None) -> Optional[Callable[[], None]]:
+        """:param received_at: monotonic time of the message, for confirmation latency
+        :return: confirmation publish, called by the dispatcher in command order
+        """
+
+        # todo: validate params
+
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Processing \'value\' method with params: {params}')
+
+        bus_id, pin_id = self.parse_obj_id(obj_id=params['object_identifier'])
 
         if params['object_type'] == ObjType.BINARY_OUTPUT.id:
-            delay = self.get_pulse_delay(bus_id=bus_id, pin_id=pin_id)
+            pin = self.routes.pin(bus_id=bus_id, pin_id=pin_id)
+            delay = pin.pulse_delay
             value = bool(params['value'])
 
-            if value == self.get_default(bus_id=bus_id, pin_id=pin_id):
-                _log.debug(f'Received default value: {value}')
+            if value == pin.default:
+                if _log.isEnabledFor(logging.DEBUG):
+                    _log.debug(f'Received default value: {value}')
                 return
 
             if delay:
-                self._wr_p_s_wr_p(value=value, bus_id=bus_id, pin_id=pin_id, delay=delay)
-            else:
-                self._wr_p(value=value, bus_id=bus_id, pin_id=pin_id)
+                return await self._wr_p_s_wr_p(value=value, bus_id=bus_id, pin_id=pin_id,
+                                               delay=delay, received_at=received_at)
+            # new steady value overrides a running pulse
+            self.pulses.cancel(key=(bus_id, pin_id))
+            return await self._wr_p(value=value, bus_id=bus_id, pin_id=pin_id,
+                                    received_at=received_at)
 
         elif params['object_type'] == ObjType.BINARY_INPUT.id:
-            self._r_p(bus_id=bus_id, pin_id=pin_id)
+            return await self._r_p(bus_id=bus_id, pin_id=pin_id)
         else:
             raise ValueError(
                 f'Expected only {ObjType.BINARY_INPUT} or {ObjType.BINARY_OUTPUT}')
 
-    def read_i2c(self, bus_id, pin_id):  #: int):  # , obj_type: int, dev_id: int) -> bool:
+    async def read_i2c(self, bus_id, pin_id):  #: int):  # , obj_type: int, dev_id: int) -> bool:
         try:
-            # inverting because False=turn on, True=turn off
-            v = not self.pins[bus_id][pin_id].value
-            _log.debug(f'Read: bus={bus_id} pin={pin_id} value={v}')
+            # inverted pins: False=turn on, True=turn off
+            v = (await self.io[bus_id].read(_get_value, self.pins[bus_id][pin_id])
+                 != self.routes.pin(bus_id=bus_id, pin_id=pin_id).inverted)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f'Read: bus={bus_id} pin={pin_id} value={v}')
             return v
         except LookupError as e:
             _log.warning(e,
                          exc_info=True
                          )
+        except OSError as e:
+            _log.warning(f'Bus: {bus_id} read error: {e}')
         except ValueError:
             _log.warning('Please, provide correct object_id (for splitting to bus and pin)')
 
-    def _r_p(self, bus_id, pin_id):
-        value = self.read_i2c(bus_id=bus_id, pin_id=pin_id)
-        payload = '{0} {1} {2} {3}'.format(self.device_id,
-                                           ObjType.BINARY_INPUT.id,
-                                           f'{bus_id}0{pin_id}',
-                                           value,
-                                           )
-        self.publish(topic=self.get_topic(bus_id=bus_id, pin_id=pin_id),
-                     payload=payload,
-                     qos=1, retain=True
-                     )
-
-    def write_i2c(self, value, bus_id, pin_id):
-        # value: bool, obj_id: int) -> None:  # , obj_type: int, dev_id: int):
+    async def read_bus(self, bus_id):  # -> Optional[int]:
+        """Reads the whole GPIO port of bi_bus in one transaction.
+
+        :return: raw port byte (bit=1 means pin is high) or None if read failed
+        """
         try:
-            value = not value
-            _log.debug(f'Write bus={bus_id}, pin={pin_id} value={value}')
-            self.bo_pins[bus_id][pin_id].value = value
+            port = await self.io[bus_id].read(_get_gpio, self._bi_expanders[bus_id])
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f'Read: bus={bus_id} port={port:#010b}')
+            return port
+        except LookupError as e:
+            _log.warning(e,
+                         exc_info=True
+                         )
+        except OSError as e:
+            _log.warning(f'Bus: {bus_id} read error: {e}')
+
+    async def _r_p(self, bus_id, pin_id):
+        value = await self.read_i2c(bus_id=bus_id, pin_id=pin_id)
+        if value is None:
+            return
+        pin = self.routes.pin(bus_id=bus_id, pin_id=pin_id)
+        return partial(self._publish_confirmation, method='value', topic=pin.topic,
+                       payload=pin.payloads[value], key=pin.obj_id, received_at=None)
+
+    def _publish_confirmation(self, method, topic, payload, key, received_at):
+        # method: str, topic: str, payload: str, key: Optional[str],
+        # received_at: Optional[float]) -> None:
+        self.publish(topic=topic, payload=payload, qos=1, retain=True, key=key)
+        if received_at is not None:
+            self._confirm_time.labels(method).observe(monotonic() - received_at)
+
+    def _write_port(self, bus_id, port):
+        # Executed in the bus worker: pushes the whole port byte in one transaction.
+        self._bo_expanders[bus_id].gpio = port
+        self._olat[bus_id] = port
+        if self.state is not None:
+            pulse_mask = self._pulse_mask[bus_id]
+            self.state.set_output(bus_id=bus_id,
+                                  port=(port & ~pulse_mask) | self._pulse_levels[bus_id])
+
+    def _set_pulse_rest(self, bus_id, mask, levels):
+        # Called in the event loop before a pulse is written.
+        self._pulse_mask[bus_id] |= mask
+        self._pulse_levels[bus_id] = (self._pulse_levels[bus_id] & ~mask) | (levels & mask)
+
+    def _write_port_bits(self, bus_id, mask, levels):
+        # Executed in the bus worker, so composing the byte is not racing
+        # with other pins of the bus.
+        port = (self._olat[bus_id] & ~mask) | (levels & mask)
+        if port != self._olat[bus_id]:
+            self._write_port(bus_id=bus_id, port=port)
+
+    async def write_i2c(self, value, bus_id, pin_id):
+        # value: bool, obj_id: int) -> bool:  # , obj_type: int, dev_id: int):
+        try:
+            if not 0 <= pin_id <= 7:
+                raise ValueError(f'Pin number must be 0-7, got {pin_id}')
+            pin = self.routes.pin(bus_id=bus_id, pin_id=pin_id)
+            level = value != pin.inverted
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f'Write bus={bus_id}, pin={pin_id} value={level}')
+            await self.io[bus_id].write(self._write_port_bits, bus_id,
+                                        pin.mask, pin.mask if level else 0)
+            return True
 
         except LookupError as e:
             _log.warning(e,
                          exc_info=True
                          )
+        except OSError as e:
+            _log.warning(f'Bus: {bus_id} write error: {e}')
         except ValueError:
             _log.warning('Please, provide correct object_id (for splitting to bus and pin)')
 
-    def _wr_i2c(self, value, bus_id, pin_id):
+    async def _wr_i2c(self, value, bus_id, pin_id):
         # value: bool, obj_id: int  # , obj_type: int, dev_id: int) -> bool:
-        self.write_i2c(value=value,
-                       bus_id=bus_id,
-                       pin_id=pin_id
-                       )
-        rvalue = self.read_i2c(bus_id=bus_id,
-                               pin_id=pin_id
-                               )
-        res = value == rvalue  # because inverted
-        _log.debug(f'Write with check result={res}')
+        is_written = await self.write_i2c(value=value,
+                                          bus_id=bus_id,
+                                          pin_id=pin_id
+                                          )
+        if not self._verify_writes or not is_written:
+            return bool(is_written)
+
+        rvalue = await self.read_i2c(bus_id=bus_id,
+                                     pin_id=pin_id
+                                     )
+        res = value == rvalue
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Write with check result={res}')
         return res
 
-    def _wr_p(self, value, bus_id, pin_id):
-        _is_eq = self._wr_i2c(value=value, bus_id=bus_id, pin_id=pin_id)
+    async def _wr_p(self, value, bus_id, pin_id, received_at=None):
+        # Returns the confirmation publish if the pin is written.
+        _is_eq = await self._wr_i2c(value=value, bus_id=bus_id, pin_id=pin_id)
         if _is_eq:
-            payload = '{0} {1} {2} {3}'.format(self.device_id,
-                                               ObjType.BINARY_OUTPUT.id,
-                                               f'{bus_id}0{pin_id}',
-                                               int(value),
-                                               )
-            self.publish(topic=self.get_topic(bus_id=bus_id, pin_id=pin_id),
-                         payload=payload,
-                         qos=1, retain=True
-                         )
-
-    def _wr_p_s_wr_p(self, value, bus_id, pin_id, delay):
-        self._wr_p(value=value, bus_id=bus_id, pin_id=pin_id)
-        sleep(delay)
-        value = not value
-        self._wr_p(value=value, bus_id=bus_id, pin_id=pin_id)
+            pin = self.routes.pin(bus_id=bus_id, pin_id=pin_id)
+            return partial(self._publish_confirmation, method='value', topic=pin.topic,
+                           payload=pin.payloads[value], key=pin.obj_id,
+                           received_at=received_at)
+
+    async def _wr_p_s_wr_p(self, value, bus_id, pin_id, delay, received_at=None):
+        # Revert is scheduled instead of sleeping in the command.
+        # Pulse on the same pin while pending extends it.
+        key = (bus_id, pin_id)
+        pin = self.routes.pin(bus_id=bus_id, pin_id=pin_id)
+        self._set_pulse_rest(bus_id=bus_id, mask=pin.mask,
+                             levels=0 if value != pin.inverted else pin.mask)
+        confirmation = await self._wr_p(value=value, bus_id=bus_id, pin_id=pin_id,
+                                        received_at=received_at)
+        self.pulses.schedule(key=key, delay=delay, fn=self._submit_pulse_revert,
+                             value=not value, bus_id=bus_id, pin_id=pin_id)
+        return confirmation
+
+    def _submit_pulse_revert(self, value, bus_id, pin_id):
+        # Called by PulseScheduler. Revert is queued after commands of the pin.
+        self.commands.submit((bus_id, pin_id), self._wr_p, force=True,
+                             value=value, bus_id=bus_id, pin_id=pin_id)
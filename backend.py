@@ -0,0 +1,445 @@
+import logging
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+_log = logging.getLogger(__name__)
+
+# MCP23008 registers
+IODIR = 0x00
+IPOL = 0x01
+GPINTEN = 0x02
+DEFVAL = 0x03
+INTCON = 0x04
+IOCON = 0x05
+GPPU = 0x06
+INTF = 0x07
+INTCAP = 0x08
+GPIO = 0x09
+OLAT = 0x0A
+
+# IOCON bits
+IOCON_ODR = 0x04  # INT is an open-drain output
+
+
+class ExpanderNotFoundError(OSError):
+    """Configured expander does not answer on the I2C bus."""
+
+
+def init_expander(expander, iodir, gppu, olat=None, ipol=0x00):
+    """Configures all pins of the expander in three transactions.
+    OLAT is written before IODIR, so outputs start at their level.
+
+    :param olat: output latch, None - not written (inputs only)
+    """
+    if olat is not None:
+        expander._write_u8(OLAT, olat)
+    expander._write_u8(GPPU, gppu)
+    # IODIR and IPOL are adjacent registers: one sequential write
+    expander._write_u16le(IODIR, iodir | ipol << 8)
+
+
+class InterruptLine:
+    """INT line of expanders. Callbacks are called from a foreign thread
+    when the line is asserted.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        if callback in self._callbacks:
+            self._callbacks.remove(callback)
+
+    def fire(self):
+        for callback in list(self._callbacks):
+            callback()
+
+
+class GPIOInterruptLine(InterruptLine):
+    """INT output connected to a Raspberry Pi GPIO (BCM numbering).
+    MCP23008 INT is active-low, so falling edges are detected.
+    """
+
+    def __init__(self, pin):
+        super().__init__()
+        import RPi.GPIO as GPIO
+
+        self.pin = pin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.add_event_detect(pin, GPIO.FALLING,
+                              callback=lambda channel: self.fire())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.pin})'
+
+
+# The adafruit driver has properties only for GPIO, IODIR and GPPU registers.
+def configure_interrupts(expander, mask=0xFF):
+    """Interrupt on any change of `mask` pins (compared with previous value).
+    INT is switched to open-drain, so several expanders can share one line
+    (the GPIO input has a pull-up).
+    """
+    # SEQOP stays 0: sequential reads of INTF and INTCAP
+    expander._write_u8(IOCON, IOCON_ODR)
+    expander._write_u8(INTCON, 0x00)
+    expander._write_u8(GPINTEN, mask)
+
+
+def read_interrupt(expander):  # -> tuple[int, int]
+    """Reads INTF and INTCAP in one sequential transaction.
+    Reading INTCAP clears the interrupt.
+
+    :return: (pins which caused the interrupt, port value latched at interrupt)
+    """
+    value = expander._read_u16le(INTF)
+    return value & 0xFF, value >> 8
+
+
+class AdafruitBackend:
+    """MCP23008 expanders on the Raspberry Pi I2C bus (board.SCL, board.SDA)."""
+
+    name = 'adafruit'
+
+    def __init__(self, config: dict):
+        import board
+        import busio
+
+        self._config = config
+        self.i2c = busio.I2C(board.SCL, board.SDA)
+        self._interrupt_lines = {}  # GPIO pin: GPIOInterruptLine
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def expander(self, address):
+        from adafruit_mcp230xx.mcp23008 import MCP23008
+
+        # registers are written by `init_expander`, skip the driver reset
+        return MCP23008(self.i2c, address=address, reset=False)
+
+    def scan(self):  # -> list[int]
+        """Addresses of all devices answering on the bus, in one sweep."""
+        while not self.i2c.try_lock():
+            pass
+        try:
+            return self.i2c.scan()
+        finally:
+            self.i2c.unlock()
+
+    def interrupt_line(self, address, pin):  # -> InterruptLine
+        """INT line of the expander. Expanders may share one line (open-drain)."""
+        if pin is None:
+            raise ValueError(f'Bus: {address} int_pin is required in interrupt mode')
+        if pin not in self._interrupt_lines:
+            self._interrupt_lines[pin] = GPIOInterruptLine(pin=pin)
+        return self._interrupt_lines[pin]
+
+
+class Waveform:
+    """Scripted input levels of one simulated expander.
+
+    Every entry toggles one pin, starting from its idle level:
+        {pin: 0, period: 2.0}           - square wave, toggles every period/2
+        {pin: 3, at: [1.0, 1.5], loop: 4.0}
+                                        - toggles at given seconds since start,
+                                          optionally repeated every `loop` seconds
+    """
+
+    def __init__(self, entries, clock=monotonic):
+        self._entries = entries or []
+        self._clock = clock
+        self._t0 = clock()
+
+    def next_toggle(self):  # -> Optional[float]
+        """Seconds until the next toggle of any pin (None if there are no more)."""
+        t = self._clock() - self._t0
+        delays = []
+        for entry in self._entries:
+            if 'period' in entry:
+                half = entry['period'] / 2
+                delays.append((int(t / half) + 1) * half - t)
+            else:
+                loop = entry.get('loop')
+                ts = t % loop if loop else t
+                later = [at - ts for at in entry['at'] if at > ts]
+                if later:
+                    delays.append(min(later))
+                elif loop:
+                    delays.append(loop - ts + min(entry['at']))
+        return min(delays) if delays else None
+
+    def toggled(self):  # -> int
+        """Mask of pins which are toggled from the idle level now."""
+        t = self._clock() - self._t0
+        mask = 0
+        for entry in self._entries:
+            if 'period' in entry:
+                toggles = int(t / (entry['period'] / 2))
+            else:
+                loop = entry.get('loop')
+                ts = t % loop if loop else t
+                toggles = sum(1 for at in entry['at'] if at <= ts)
+            if toggles % 2:
+                mask |= 1 << entry['pin']
+        return mask
+
+
+class SimulatedMCP23008:
+    """In-process MCP23008 model.
+
+    Keeps the register file, sleeps `latency` seconds per transaction and
+    counts transactions. Input pin levels come from `set_inputs`/`set_input`
+    and the optional waveform.
+    Interrupts: GPINTEN/INTCON/DEFVAL conditions set INTF, latch INTCAP and
+    fire `int_line`; reading GPIO or INTCAP clears the interrupt.
+    """
+
+    def __init__(self, address, latency=0.0, waveform=None):
+        self.address = address
+        self.latency = latency
+        self.waveform = waveform
+
+        self._lock = Lock()
+        # power-on reset: all pins are inputs
+        self._registers = bytearray(11)
+        self._registers[IODIR] = 0xFF
+        # external pin levels, idle inputs are pulled up
+        self._inputs = 0xFF
+        self._prev_levels = self._levels()
+
+        self.int_line = InterruptLine()
+        self._ticker = None  # thread following the waveform for interrupts
+
+        self.transactions = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.address})'
+
+    def _transaction(self):
+        self.transactions += 1
+        if self.latency:
+            sleep(self.latency)
+
+    def _levels(self):  # -> int
+        # pin levels seen by the chip: inputs from outside, outputs from OLAT
+        inputs = self._inputs
+        if self.waveform is not None:
+            inputs ^= self.waveform.toggled()
+        iodir = self._registers[IODIR]
+        return (inputs & iodir) | (self._registers[OLAT] & ~iodir & 0xFF)
+
+    def _port(self):  # -> int
+        return self._levels() ^ (self._registers[IPOL] & self._registers[IODIR])
+
+    def _read_register(self, register):  # -> int
+        value = self._port() if register == GPIO else self._registers[register]
+        if register in (GPIO, INTCAP):
+            self._registers[INTF] = 0
+        return value
+
+    def _read_u8(self, register):  # -> int
+        self._transaction()
+        with self._lock:
+            return self._read_register(register)
+
+    def _read_u16le(self, register):  # -> int
+        # sequential read of two registers in one transaction
+        self._transaction()
+        with self._lock:
+            low = self._read_register(register)
+            return low | self._read_register(register + 1) << 8
+
+    def _write_u16le(self, register, val):
+        # sequential write of two registers in one transaction
+        self._transaction()
+        with self._lock:
+            self._write_register(register, val & 0xFF)
+            self._write_register(register + 1, val >> 8 & 0xFF)
+        self._check_interrupt()
+
+    def _write_register(self, register, val):
+        if register in (GPIO, OLAT):
+            self._registers[OLAT] = val
+        elif register not in (INTF, INTCAP):  # read-only
+            self._registers[register] = val
+
+    def _write_u8(self, register, val):
+        self._transaction()
+        with self._lock:
+            self._write_register(register, val & 0xFF)
+        if register == GPINTEN and val and self.waveform is not None:
+            self._start_ticker()
+        self._check_interrupt()
+
+    def _check_interrupt(self):
+        """Evaluates interrupt conditions after pin levels changed."""
+        with self._lock:
+            levels = self._levels()
+            enabled = self._registers[GPINTEN] & self._registers[IODIR]
+            intcon = self._registers[INTCON]
+            # INTCON=0: compare with previous value, INTCON=1: with DEFVAL
+            condition = (((levels ^ self._prev_levels) & ~intcon)
+                         | ((levels ^ self._registers[DEFVAL]) & intcon)) & enabled
+            self._prev_levels = levels
+            # no new interrupt until the pending one is cleared
+            if not condition or self._registers[INTF]:
+                return
+            self._registers[INTF] = condition
+            self._registers[INTCAP] = self._port()
+        self.int_line.fire()
+
+    def _start_ticker(self):
+        if self._ticker is not None:
+            return
+
+        def follow_waveform():
+            while True:
+                delay = self.waveform.next_toggle()
+                if delay is None:
+                    return
+                sleep(delay + 0.0001)
+                self._check_interrupt()
+
+        self._ticker = Thread(target=follow_waveform, name=f'Sim-{self.address}-INT',
+                              daemon=True)
+        self._ticker.start()
+
+    # stimulus, not bus transactions
+    @property
+    def inputs(self):  # -> int
+        """External levels of input pins (without waveform)."""
+        return self._inputs
+
+    def set_inputs(self, levels):
+        with self._lock:
+            self._inputs = levels & 0xFF
+        self._check_interrupt()
+
+    def set_input(self, pin_id, level):
+        with self._lock:
+            if level:
+                self._inputs |= 1 << pin_id
+            else:
+                self._inputs &= ~(1 << pin_id) & 0xFF
+        self._check_interrupt()
+
+    @property
+    def gpio(self):
+        return self._read_u8(GPIO)
+
+    @gpio.setter
+    def gpio(self, val):
+        self._write_u8(GPIO, val)
+
+    @property
+    def iodir(self):
+        return self._read_u8(IODIR)
+
+    @iodir.setter
+    def iodir(self, val):
+        self._write_u8(IODIR, val)
+
+    @property
+    def gppu(self):
+        return self._read_u8(GPPU)
+
+    @gppu.setter
+    def gppu(self, val):
+        self._write_u8(GPPU, val)
+
+    @property
+    def olat(self):
+        return self._read_u8(OLAT)
+
+    def get_pin(self, pin):  # -> SimulatedPin
+        if not 0 <= pin <= 7:
+            raise ValueError('Pin number must be 0-7.')
+        return SimulatedPin(pin_id=pin, mcp=self)
+
+
+class SimulatedPin:
+    """Pin of `SimulatedMCP23008` with read-modify-write register access,
+    like adafruit DigitalInOut.
+    """
+
+    def __init__(self, pin_id, mcp):
+        self._pin_id = pin_id
+        self._mask = 1 << pin_id
+        self._mcp = mcp
+
+    def _set_bit(self, register, enabled):
+        val = self._mcp._read_u8(register)
+        self._mcp._write_u8(register, val | self._mask if enabled else val & ~self._mask)
+
+    def switch_to_input(self, pull_up=False):
+        self._set_bit(IODIR, True)
+        self._set_bit(GPPU, pull_up)
+
+    def switch_to_output(self, value=False):
+        self._set_bit(IODIR, False)
+        self.value = value
+
+    @property
+    def value(self):  # -> bool
+        return bool(self._mcp.gpio & self._mask)
+
+    @value.setter
+    def value(self, val):
+        self._set_bit(GPIO, val)
+
+
+class SimulatedBackend:
+    """Simulated expanders, no hardware required.
+
+    Configured by `simulation` section of i2c.yaml:
+        latency: seconds per transaction
+        waveforms: {<bus_id>: [<Waveform entry>, ...]}
+        absent: [<bus_id>, ...] - addresses which do not answer
+    """
+
+    name = 'simulated'
+
+    def __init__(self, config: dict):
+        self._config = config.get('simulation') or {}
+        # every configured expander answers, unless it is listed as absent
+        self._addresses = [*(config.get('bi_buses') or {}), *(config.get('bo_buses') or {})]
+        self.latency = self._config.get('latency', 0.0)
+        self.expanders = {}  # address: SimulatedMCP23008
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def expander(self, address):  # -> SimulatedMCP23008
+        entries = (self._config.get('waveforms') or {}).get(address)
+        self.expanders[address] = SimulatedMCP23008(
+            address=address,
+            latency=self.latency,
+            waveform=Waveform(entries=entries) if entries else None
+        )
+        _log.info(f'Simulated MCP23008 {address} created')
+        return self.expanders[address]
+
+    def scan(self):  # -> list[int]
+        absent = set(self._config.get('absent') or ())
+        return [address for address in self._addresses if address not in absent]
+
+    def interrupt_line(self, address, pin):  # -> InterruptLine
+        # every simulated expander has its own INT line, pin is not used
+        return self.expanders[address].int_line
+
+
+def get_backend(config: dict):
+    """Backend selected by `backend` in i2c.yaml (default: adafruit)."""
+    name = config.get('backend', AdafruitBackend.name)
+    if name == AdafruitBackend.name:
+        return AdafruitBackend(config=config)
+    if name == SimulatedBackend.name:
+        return SimulatedBackend(config=config)
+    raise ValueError(f'Unknown I2C backend: {name}')
@@ -0,0 +1,236 @@
+"""Benchmark of poll-to-publish and command-to-relay paths.
+
+Drives `VisioMQTTClient` and `I2CConnector` with the simulated MCP23008 backend
+and the loopback broker, so no hardware or network is required.
+
+    python3 bench.py --output bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import threading
+from json import dumps
+from pathlib import Path
+from time import monotonic, process_time, sleep, time
+
+from loopback import LoopbackClient, default_broker
+from mqtt import VisioMQTTClient
+
+_log = logging.getLogger(__name__)
+
+DEVICE_ID = 666
+BI_BUS = 30
+BO_BUS = 37
+
+
+class Expectation:
+    __slots__ = ('event', 'received_at')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.received_at = None
+
+
+class Probe:
+    """Subscriber of the loopback broker, which waits for expected messages."""
+
+    def __init__(self, broker):
+        self._lock = threading.Lock()
+        self._expected = {}  # (topic, payload): Expectation
+
+        self._client = LoopbackClient(broker=broker)
+        self._client.on_message = self._on_message
+        self._client.connect(host='loopback')
+        self._client.subscribe(topic='#')
+
+    def expect(self, topic, payload):  # -> Expectation
+        expectation = Expectation()
+        with self._lock:
+            self._expected[(topic, payload)] = expectation
+        return expectation
+
+    def publish(self, topic, payload):
+        self._client.publish(topic=topic, payload=payload)
+
+    def _on_message(self, client, userdata, message):
+        received_at = monotonic()
+        with self._lock:
+            expectation = self._expected.pop((message.topic, message.payload), None)
+        if expectation is not None:
+            expectation.received_at = received_at
+            expectation.event.set()
+
+
+def percentiles(values):  # -> dict
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def q(p):
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+    return {'count': len(values),
+            'p50': q(0.5),
+            'p99': q(0.99),
+            'max': values[-1],
+            'mean': sum(values) / len(values),
+            }
+
+
+def make_configs(args):  # -> tuple[dict, dict]
+    mqtt_cfg = {'device_id': DEVICE_ID,
+                'host': 'loopback',
+                'port': 1883,
+                'transport': 'loopback',
+                'username': None,
+                'password': None,
+                'subscribe': ['Set/yard/#'],
+                'publish': {bus_id: {'interval': 3600,
+                                     'bus_topic': f'Bus/{bus_id}',
+                                     'pin_topic': {pin_id: f'Pin/{bus_id}/{pin_id}'
+                                                   for pin_id in range(8)},
+                                     }
+                            for bus_id in [BI_BUS + i for i in range(args.bi_buses)] + [BO_BUS]},
+                }
+    i2c_cfg = {'backend': 'simulated',
+               'simulation': {'latency': args.latency},
+               'bi_buses': {BI_BUS + i: {'realtime_interval': args.interval}
+                            for i in range(args.bi_buses)},
+               'bo_buses': {BO_BUS: {'default': {'bus': None}}},
+               }
+    return mqtt_cfg, i2c_cfg
+
+
+def bench_detection(client, probe, args):  # -> list[float]
+    """Input toggle -> change-of-value publish."""
+    api = client.api
+    latencies = []
+    for _ in range(args.toggles):
+        bus_id = BI_BUS + random.randrange(args.bi_buses)
+        pin_id = random.randrange(8)
+        expander = api.backend.expanders[bus_id]
+        level = not expander.inputs & (1 << pin_id)
+
+        pin = api.routes.pin(bus_id=bus_id, pin_id=pin_id)
+        state = level != pin.inverted
+        expectation = probe.expect(topic=pin.topic, payload=pin.payloads[state])
+
+        t0 = monotonic()
+        expander.set_input(pin_id=pin_id, level=level)
+        if expectation.event.wait(timeout=args.interval * 20):
+            latencies.append(expectation.received_at - t0)
+        else:
+            _log.warning(f'Change of {pin.obj_id} not published')
+        # do not toggle in phase with the poll loop
+        sleep(random.uniform(0, args.interval))
+    return latencies
+
+
+def bench_commands(client, probe, args):  # -> list[float]
+    """'value' command -> confirmation publish, in bursts over all outputs."""
+    api = client.api
+    latencies = []
+    for round_id in range(args.bursts):
+        value = round_id % 2 == 0
+        pending = []
+        for pin_id in range(8):
+            pin = api.routes.pin(bus_id=BO_BUS, pin_id=pin_id)
+            expectation = probe.expect(topic=pin.topic, payload=pin.payloads[value])
+            payload = dumps({'method': 'value',
+                             'params': {'device_id': DEVICE_ID,
+                                        'object_type': pin.obj_type.id,
+                                        'object_identifier': int(pin.obj_id),
+                                        'value': int(value),
+                                        }})
+            t0 = monotonic()
+            probe.publish(topic='Set/yard/bench', payload=payload)
+            pending.append((t0, expectation))
+
+        for t0, expectation in pending:
+            if expectation.event.wait(timeout=5):
+                latencies.append(expectation.received_at - t0)
+            else:
+                _log.warning('Command not confirmed')
+    return latencies
+
+
+def bench_idle_cpu(client, args):  # -> float
+    """CPU seconds of the process per poll cycle while inputs are quiet."""
+    stats = client.api.bus_stats.values()
+    cycles0 = sum(s.cycles for s in stats)
+    cpu0 = process_time()
+    sleep(args.idle)
+    cycles = sum(s.cycles for s in stats) - cycles0
+    return (process_time() - cpu0) / cycles if cycles else 0.0
+
+
+def run(args):  # -> dict
+    mqtt_cfg, i2c_cfg = make_configs(args)
+    probe = Probe(broker=default_broker)
+
+    client = VisioMQTTClient(config=mqtt_cfg, i2c_config=i2c_cfg)
+    threading.Thread(target=asyncio.run, args=(client.run(),), name='Loop',
+                     daemon=True).start()
+    sleep(max(1.0, args.interval * 5))  # startup publishes
+
+    t0 = monotonic()
+    published0 = default_broker.published
+
+    detection = bench_detection(client=client, probe=probe, args=args)
+    commands = bench_commands(client=client, probe=probe, args=args)
+    duration = monotonic() - t0
+    messages = default_broker.published - published0
+
+    cpu_per_cycle = bench_idle_cpu(client=client, args=args)
+    client.stop()
+
+    return {'timestamp': time(),
+            'python': sys.version.split()[0],
+            'params': vars(args),
+            'detection_latency': percentiles(detection),
+            'command_latency': percentiles(commands),
+            'cpu_per_poll_cycle': cpu_per_cycle,
+            'messages_per_second': messages / duration if duration else 0.0,
+            'bus_stats': {bus_id: stats.as_dict()
+                          for bus_id, stats in client.api.bus_stats.items()},
+            'commands': client.api.commands.as_dict(),
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', type=Path, default=Path('bench_results.json'),
+                        help='JSON file with results')
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help='realtime_interval of input buses, sec')
+    parser.add_argument('--latency', type=float, default=0.0003,
+                        help='simulated I2C transaction time, sec')
+    parser.add_argument('--bi-buses', type=int, default=3)
+    parser.add_argument('--toggles', type=int, default=50)
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--idle', type=float, default=3.0,
+                        help='seconds of quiet polling for CPU measurement')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    results = run(args=args)
+
+    args.output.write_text(json.dumps(results, indent=2, default=str))
+    for name in ('detection_latency', 'command_latency'):
+        r = results[name]
+        if r['count']:
+            print(f'{name}: p50={r["p50"] * 1000:.2f} ms p99={r["p99"] * 1000:.2f} ms '
+                  f'n={r["count"]}')
+    print(f'cpu_per_poll_cycle: {results["cpu_per_poll_cycle"] * 1000:.3f} ms')
+    print(f'messages_per_second: {results["messages_per_second"]:.1f}')
+    print(f'Results saved to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
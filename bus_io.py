@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+
+_log = logging.getLogger(__name__)
+
+
+class BusTimeoutError(TimeoutError):
+    """Bus transaction was not completed in time."""
+
+
+class BusWorker:
+    """Dedicated thread which serialises all transactions of one bus.
+
+    Blocking I2C calls are executed in the worker thread, so a slow or stuck bus
+    delays only its own transactions, not the event loop.
+    """
+
+    def __init__(self, bus_id, lock: Lock, timeout: float, transaction_time=None):
+        """:param transaction_time: histogram value of transaction durations"""
+        self.bus_id = bus_id
+        self.timeout = timeout
+        self.transaction_time = transaction_time
+
+        # Expanders share one physical I2C line (and the driver shares one
+        # buffer between devices), so transactions are also guarded by its lock.
+        self._lock = lock
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix=f'Bus-{bus_id}'
+                                            )
+        self.transactions = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(bus={self.bus_id})'
+
+    def _transaction(self, fn, *args):
+        if not self._lock.acquire(timeout=self.timeout):
+            raise BusTimeoutError(f'Bus: {self.bus_id} I2C line is busy')
+        t0 = perf_counter()
+        try:
+            self.transactions += 1
+            return fn(*args)
+        except OSError:
+            self.errors += 1
+            raise
+        finally:
+            self._lock.release()
+            if self.transaction_time is not None:
+                self.transaction_time.observe(perf_counter() - t0)
+
+    async def _call(self, fn, *args, timeout=None):
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._transaction, fn, *args)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise BusTimeoutError(
+                f'Bus: {self.bus_id} transaction timeout {timeout} sec') from None
+
+    async def read(self, fn, *args, timeout=None):
+        """Awaitable read transaction: `fn(*args)` in the bus thread."""
+        return await self._call(fn, *args, timeout=timeout)
+
+    async def write(self, fn, *args, timeout=None):
+        """Awaitable write transaction: `fn(*args)` in the bus thread."""
+        return await self._call(fn, *args, timeout=timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class BusIOExecutor:
+    """Keeps one `BusWorker` per bus."""
+
+    def __init__(self, timeout: float = 0.5, metrics=None):
+        self._timeout = timeout
+        self._line_lock = Lock()
+        self._workers = {}
+
+        self._transaction_time = None
+        if metrics is not None:
+            self._transaction_time = metrics.histogram(
+                'panel_i2c_transaction_seconds', 'I2C transaction time', labels=('bus',))
+            transactions = metrics.counter(
+                'panel_i2c_transactions_total', 'I2C transactions', labels=('bus',))
+            timeouts = metrics.counter(
+                'panel_i2c_timeouts_total', 'I2C transaction timeouts', labels=('bus',))
+            errors = metrics.counter(
+                'panel_i2c_errors_total', 'I2C transaction errors', labels=('bus',))
+
+            def collect():
+                for worker in list(self._workers.values()):
+                    transactions.labels(worker.bus_id).set(worker.transactions)
+                    timeouts.labels(worker.bus_id).set(worker.timeouts)
+                    errors.labels(worker.bus_id).set(worker.errors)
+
+            metrics.add_collector(collect)
+
+    def __getitem__(self, bus_id):  # -> BusWorker
+        return self._workers[bus_id]
+
+    def __iter__(self):
+        return iter(self._workers.values())
+
+    def add_bus(self, bus_id, timeout=None):  # -> BusWorker
+        if bus_id not in self._workers:
+            self._workers[bus_id] = BusWorker(bus_id=bus_id,
+                                              lock=self._line_lock,
+                                              timeout=timeout or self._timeout,
+                                              transaction_time=(
+                                                  self._transaction_time.labels(bus_id)
+                                                  if self._transaction_time is not None else None)
+                                              )
+            _log.debug(f'Worker for bus {bus_id} added')
+        return self._workers[bus_id]
+
+    def shutdown(self):
+        for worker in self._workers.values():
+            worker.shutdown()
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+_log = logging.getLogger(__name__)
+
+
+class CommandQueueFull(Exception):
+    """Too many pending commands for one pin."""
+
+
+class Command:
+    __slots__ = ('seq', 'fn', 'kwargs', 'keys', 'enqueued_at', 'due_at', 'coalesce',
+                 'started', 'arrived', 'done')
+
+    def __init__(self, seq, fn, kwargs, keys, enqueued_at, due_at, coalesce):
+        self.seq = seq
+        self.fn = fn
+        self.kwargs = kwargs
+        self.keys = keys
+        self.enqueued_at = enqueued_at
+        self.due_at = due_at  # end of the intake window
+        self.coalesce = coalesce
+        self.started = False
+        # command of several keys: queues where it is the head, set when executed
+        self.arrived = 0
+        self.done = asyncio.Event() if len(keys) > 1 else None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(seq={self.seq} {self.kwargs})'
+
+
+class CommandDispatcher:
+    """Executes commands as tasks of the event loop.
+
+    Commands with the same key (bus_id, pin_id) are executed one by one in
+    arrival order, commands for different keys run concurrently,
+    at most `max_workers` keys at a time. A command of several keys
+    (one write of several pins) is ordered with the commands of each of them.
+
+    Every accepted command gets a sequence number. A coalescing command waits
+    `coalesce_window` seconds before it starts; a newer coalescing command of
+    the same key replaces it (last writer wins) and keeps its start time,
+    so a burst of commands for one pin is one bus write. Commands return a confirmation callable, which
+    is called in sequence order once all earlier commands are done.
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue_depth: int = 8,
+                 coalesce_window: float = 0.0, metrics=None):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.coalesce_window = coalesce_window
+
+        # created in the event loop (asyncio primitives are bound to it)
+        self._slots = None  # asyncio.Semaphore
+        self._tasks = set()
+        # key: deque of Command. Head is the running (or waiting) command.
+        self._queues = {}
+
+        self._seq = 0  # of the last accepted command
+        self._confirmed_seq = 0  # all commands up to it are confirmed
+        self._confirmations = {}  # seq: Optional[Callable[[], None]], done out of order
+
+        # backpressure metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+        self._wait_time = None
+        if metrics is not None:
+            self._wait_time = metrics.histogram(
+                'panel_rpc_queue_wait_seconds', 'Time RPC commands wait in the queue'
+            ).labels()
+            pending = metrics.gauge('panel_rpc_pending', 'Pending RPC commands')
+            counters = {name: metrics.counter(f'panel_rpc_{name}_total', f'RPC commands {name}')
+                        for name in ('submitted', 'completed', 'failed', 'rejected',
+                                     'coalesced')}
+
+            def collect():
+                pending.set(self.pending)
+                for name, counter in counters.items():
+                    counter.labels().set(getattr(self, name))
+
+            metrics.add_collector(collect)
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def submit(self, key, fn, force=False, coalesce=False, **kwargs):
+        # key: Union[tuple, list[tuple]], fn: Callable, force: bool = False,
+        # coalesce: bool = False, **kwargs) -> int:
+        """Queues coroutine `fn(**kwargs)` for the key. Called in the event loop.
+
+        :param key: key or list of keys. A command of several keys is executed
+            once, after earlier commands of all its keys
+        :param force: bypass `max_queue_depth` (internal commands which must not be lost)
+        :param coalesce: the command sets the final state of the key, so it may
+            replace a waiting coalescing command and be replaced by a newer one.
+            Single key only
+        :raise CommandQueueFull: if key already has `max_queue_depth` pending commands
+        :return: sequence number of the command
+        """
+        keys = key if isinstance(key, list) else [key]
+        coalesce = coalesce and len(keys) == 1
+        queues = [self._queues.get(queue_key) or deque() for queue_key in keys]
+        tails = [queue[-1] if queue else None for queue in queues]
+        now = monotonic()
+        due_at = now + self.coalesce_window
+        tail = tails[0]
+        if coalesce and tail is not None and tail.coalesce and not tail.started:
+            due_at = tail.due_at
+            # last writer wins: the waiting command is dropped unconfirmed
+            self.coalesced += 1
+            self.pending -= 1
+            self._confirm(seq=tail.seq, confirmation=None)
+            queues[0].pop()
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug(f'{key} {tail} replaced by a newer command')
+        elif not force:
+            for queue_key, queue in zip(keys, queues):
+                if len(queue) >= self.max_queue_depth:
+                    self.rejected += 1
+                    raise CommandQueueFull(
+                        f'{queue_key} has {len(queue)} pending commands '
+                        f'(max_queue_depth={self.max_queue_depth})')
+
+        self._seq += 1
+        command = Command(seq=self._seq, fn=fn, kwargs=kwargs, keys=keys, enqueued_at=now,
+                          due_at=due_at, coalesce=coalesce)
+        self.submitted += 1
+        self.pending += 1
+        if self.pending > self.max_pending:
+            self.max_pending = self.pending
+
+        loop = asyncio.get_running_loop()
+        for queue_key, queue, tail in zip(keys, queues, tails):
+            queue.append(command)
+            if tail is None:
+                # nothing runs for the key - start draining
+                self._queues[queue_key] = queue
+                task = loop.create_task(self._drain(queue_key), name=f'RPC-{queue_key}')
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return self._seq
+
+    async def _drain(self, key):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        queue = self._queues[key]
+        while queue:
+            command = queue[0]
+            if command.done is not None:
+                # executed by the drain of the last of its keys to reach it
+                command.arrived += 1
+                if command.arrived < len(command.keys):
+                    await command.done.wait()
+                    queue.popleft()
+                    continue
+            elif command.coalesce and self.coalesce_window:
+                # intake window: a newer command of the key may replace this one
+                delay = command.due_at - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    if queue[0] is not command:
+                        continue
+
+            command.started = True
+            async with self._slots:
+                wait_time = monotonic() - command.enqueued_at
+                self.total_wait_time += wait_time
+                if wait_time > self.max_wait_time:
+                    self.max_wait_time = wait_time
+                if self._wait_time is not None:
+                    self._wait_time.observe(wait_time)
+
+                confirmation = None
+                try:
+                    confirmation = await command.fn(**command.kwargs)
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    _log.warning(f'Command {key} {command} error: {e}',
+                                 exc_info=True
+                                 )
+
+            queue.popleft()
+            self.pending -= 1
+            self._confirm(seq=command.seq, confirmation=confirmation)
+            if command.done is not None:
+                command.done.set()
+        del self._queues[key]
+
+    def _confirm(self, seq, confirmation):
+        # seq: int, confirmation: Optional[Callable[[], None]]) -> None:
+        """Calls confirmations of all commands done without a gap, in sequence order."""
+        self._confirmations[seq] = confirmation
+        while self._confirmed_seq + 1 in self._confirmations:
+            self._confirmed_seq += 1
+            confirmation = self._confirmations.pop(self._confirmed_seq)
+            if confirmation is None:
+                continue
+            try:
+                confirmation()
+            except Exception as e:
+                _log.warning(f'Command {self._confirmed_seq} confirmation error: {e}',
+                             exc_info=True
+                             )
+
+    def queue_depth(self, key):  # -> int
+        return len(self._queues.get(key, ()))
+
+    @property
+    def avg_wait_time(self):  # -> float
+        done = self.completed + self.failed
+        if not done:
+            return 0.0
+        return self.total_wait_time / done
+
+    def as_dict(self):  # -> dict
+        return {'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'coalesced': self.coalesced,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'last_seq': self._seq,
+                'unconfirmed': self._seq - self._confirmed_seq,
+                'avg_wait_time': self.avg_wait_time,
+                'max_wait_time': self.max_wait_time,
+                }
+
+    def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
@@ -0,0 +1,92 @@
+from collections import deque
+from functools import reduce
+from itertools import islice
+from operator import and_, or_
+
+
+class Debouncer:
+    """Debounced port byte of one bus.
+
+    A pin takes a new level only when its raw level is the same for the last
+    `samples` reads and for at least `stable_time` seconds. Shorter changes are
+    suppressed and counted per pin.
+    """
+
+    def __init__(self, samples, stable_times):
+        # samples: tuple[int, ...], stable_times: tuple[float, ...]) -> None:
+        """:param samples: samples per pin, 1 - no sample filter
+        :param stable_times: seconds per pin, 0 - no time filter
+        """
+        # pins with the same number of samples share one history window
+        self._groups = {}  # samples: mask
+        for pin_id, n in enumerate(samples):
+            self._groups[n] = self._groups.get(n, 0) | 1 << pin_id
+        self._history = deque(maxlen=max(samples))  # raw port bytes, newest last
+
+        self._stable_times = stable_times
+        self._timed_mask = sum(1 << pin_id for pin_id, t in enumerate(stable_times) if t)
+        self._since = [0.0] * len(stable_times)  # when the raw level last changed
+
+        self.state = None  # debounced port byte
+        self.pending = 0  # pins whose raw level differs from the debounced one
+        self.suppressed = [0] * len(samples)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._groups})'
+
+    @classmethod
+    def for_bus(cls, bus):
+        # bus: BusRecord) -> Optional[Debouncer]:
+        """:return: debouncer or None if no pin of the bus is debounced"""
+        samples = tuple(max(pin.debounce or 1, 1) for pin in bus.pins)
+        stable_times = tuple(pin.debounce_time or 0.0 for pin in bus.pins)
+        if max(samples) == 1 and not any(stable_times):
+            return None
+        return cls(samples=samples, stable_times=stable_times)
+
+    @property
+    def suppressed_total(self):  # -> int
+        return sum(self.suppressed)
+
+    def update(self, port, now):  # -> int
+        """:param port: raw port byte
+        :param now: monotonic time of the read
+        :return: debounced port byte
+        """
+        if self.state is None:
+            self._history.append(port)
+            self.state = port
+            return port
+
+        toggled = port ^ self._history[-1]
+        self._history.append(port)
+        for pin_id in range(len(self._since)):
+            if toggled >> pin_id & 1:
+                self._since[pin_id] = now
+
+        pending = port ^ self.state
+        # a pending pin came back before it was accepted
+        glitches = self.pending & ~pending
+        if glitches:
+            for pin_id in range(len(self.suppressed)):
+                if glitches >> pin_id & 1:
+                    self.suppressed[pin_id] += 1
+
+        accepted = 0
+        if pending:
+            history_len = len(self._history)
+            for n, mask in self._groups.items():
+                if not pending & mask or history_len < n:
+                    continue
+                window = list(islice(self._history, history_len - n, history_len))
+                # bits equal in every sample of the window
+                stable = reduce(and_, window) | ~reduce(or_, window) & 0xFF
+                accepted |= pending & mask & stable
+            for pin_id in range(len(self._stable_times)):
+                if ((accepted & self._timed_mask) >> pin_id & 1
+                        and now - self._since[pin_id] < self._stable_times[pin_id]):
+                    accepted &= ~(1 << pin_id)
+
+        self.state ^= accepted
+        self.pending = pending & ~accepted
+        return self.state
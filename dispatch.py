@@ -0,0 +1,174 @@
+import logging
+import re
+from json import JSONDecodeError, loads
+
+from paho.mqtt.client import topic_matches_sub
+
+_log = logging.getLogger(__name__)
+
+# Byte-level pre-filter: payloads without our device id or a handled method
+# are dropped before JSON decode. Nested "device_id" or "method" keys only let
+# the message through to the full check.
+_DEVICE_ID_RE = re.compile(rb'"device_id"\s*:\s*(-?\d+)')
+_METHOD_RE = re.compile(rb'"method"\s*:\s*"([^"\\]*)"')
+
+# params schemas: field: type(s), [schema] - list of objects
+VALUE_SCHEMA = {'device_id': int,
+                'object_type': int,
+                'object_identifier': (int, str),
+                }
+# 'value' of binary-output writes, binary-input reads have none
+BO_VALUE_SCHEMA = {'value': (int, float)}
+VALUES_SCHEMA = {'device_id': int,
+                 'values': [{'object_type': int,
+                             'object_identifier': (int, str),
+                             'value': (int, float),
+                             }],
+                 }
+
+
+def validate(data, schema, path='params'):
+    # data: Any, schema: dict, path: str = 'params') -> None:
+    """:raise ValueError: with the path of the first invalid field"""
+    if not isinstance(data, dict):
+        raise ValueError(f'{path} must be an object')
+    for field, kind in schema.items():
+        if field not in data:
+            raise ValueError(f'{path}.{field} is required')
+        value = data[field]
+        if isinstance(kind, list):
+            if not isinstance(value, list):
+                raise ValueError(f'{path}.{field} must be a list')
+            for i, entry in enumerate(value):
+                validate(entry, kind[0], path=f'{path}.{field}[{i}]')
+        elif not isinstance(value, kind):
+            names = '/'.join(t.__name__ for t in (kind if isinstance(kind, tuple) else (kind,)))
+            raise ValueError(f'{path}.{field} must be {names}')
+
+
+class Route:
+    __slots__ = ('topic_filter', 'method', 'handler', 'schema')
+
+    def __init__(self, topic_filter, method, handler, schema):
+        self.topic_filter = topic_filter
+        self.method = method
+        self.handler = handler
+        self.schema = schema
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.topic_filter} {self.method})'
+
+
+class MessageDispatcher:
+    """Routes RPC messages to handlers by topic filter and method.
+
+    Only messages which pass the topic, method and device id checks on raw
+    bytes are decoded, so commands for other panels on a shared topic cost
+    a regex scan. Decoded params are validated against the route schema.
+    """
+
+    # topics remembered with their route per method
+    max_cached_topics = 1024
+
+    def __init__(self, device_id, on_invalid=None, metrics=None):
+        # device_id: int, on_invalid: Callable[[str, Any, str], None] = None,
+        # metrics: MetricsRegistry = None) -> None:
+        """:param on_invalid: called with method, params and error message
+        of a message for this device which failed validation
+        """
+        self.device_id = device_id
+        self._device_id = str(device_id).encode()
+        self._on_invalid = on_invalid
+        self._routes = {}  # method: list of Route
+        self._cache = {}  # (topic, method): Optional[Route]
+
+        self.received = 0
+        self.filtered = 0  # not for this device or not handled
+        self.invalid = 0
+        self.dispatched = 0
+
+        if metrics is not None:
+            messages = metrics.counter('panel_mqtt_messages_total',
+                                       'Received RPC messages by result',
+                                       labels=('result',))
+
+            def collect():
+                for result in ('received', 'filtered', 'invalid', 'dispatched'):
+                    messages.labels(result).set(getattr(self, result))
+
+            metrics.add_collector(collect)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.device_id})'
+
+    def add(self, topic_filter, method, handler, schema=None):
+        # topic_filter: str, method: str, handler: Callable[..., None],
+        # schema: dict = None) -> None:
+        """Calls `handler(params=params)` for `method` messages on `topic_filter`."""
+        self._routes.setdefault(method, []).append(
+            Route(topic_filter=topic_filter, method=method, handler=handler, schema=schema))
+        self._cache.clear()
+
+    def route(self, topic, method):  # -> Optional[Route]
+        key = (topic, method)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        route = next((route for route in self._routes.get(method, ())
+                      if topic_matches_sub(route.topic_filter, topic)), None)
+        if len(self._cache) >= self.max_cached_topics:
+            self._cache.clear()
+        self._cache[key] = route
+        return route
+
+    def dispatch(self, topic, payload):  # -> bool
+        # topic: str, payload: Union[bytes, str]) -> bool:
+        """:return: True if the message was passed to a handler"""
+        self.received += 1
+        if isinstance(payload, str):
+            payload = payload.encode()
+
+        # nested "method" keys may come first, any handled candidate passes
+        if (not any(self.route(topic=topic, method=method.decode('utf-8', 'ignore'))
+                    for method in _METHOD_RE.findall(payload))
+                or self._device_id not in _DEVICE_ID_RE.findall(payload)):
+            self.filtered += 1
+            return False
+
+        try:
+            msg = loads(payload)
+        except (JSONDecodeError, UnicodeDecodeError) as e:
+            self.invalid += 1
+            _log.warning(f'Cannot decode {topic} message: {e}')
+            return False
+        method = msg.get('method') if isinstance(msg, dict) else None
+        route = self.route(topic=topic, method=method) if isinstance(method, str) else None
+        params = msg.get('params') if route is not None else None
+        # the pre-filter may have matched nested keys
+        if not isinstance(params, dict) or params.get('device_id') != self.device_id:
+            self.filtered += 1
+            return False
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'Received {topic}:{msg}')
+
+        if route.schema is not None:
+            try:
+                validate(params, route.schema)
+            except ValueError as e:
+                self.invalid += 1
+                _log.warning(f'Invalid \'{route.method}\' params {params}: {e}')
+                if self._on_invalid is not None:
+                    self._on_invalid(route.method, params, f'Invalid params: {e}')
+                return False
+
+        self.dispatched += 1
+        route.handler(params=params)
+        return True
+
+    def as_dict(self):  # -> dict
+        return {'received': self.received,
+                'filtered': self.filtered,
+                'invalid': self.invalid,
+                'dispatched': self.dispatched,
+                }
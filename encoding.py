@@ -0,0 +1,117 @@
+from json import dumps
+from struct import Struct
+
+
+class PayloadEncoder:
+    """Renders pin state payloads.
+
+    Payloads of both states are rendered once per pin by `prepare`,
+    so publishing a state is just a tuple lookup: `pin.payloads[value]`.
+    """
+
+    name = None
+
+    def __init__(self, device_id):
+        self._device_id = device_id
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def prepare(self, pin):
+        # pin: PinRecord) -> None:
+        pin.payloads = (self.render(pin=pin, value=0), self.render(pin=pin, value=1))
+
+    def render(self, pin, value):  # -> bytes
+        raise NotImplementedError
+
+    def encode(self, pin, value):  # -> bytes
+        return pin.payloads[value]
+
+    def encode_batch(self, pins_values):  # -> bytes
+        """:param pins_values: iterable of (PinRecord, value)"""
+        raise NotImplementedError
+
+    def encode_snapshot(self, bus, states, timestamp, seq):
+        # bus: BusRecord, states: int, timestamp: float, seq: int) -> bytes:
+        """States of all pins of the bus in one message.
+
+        :param states: port byte with inversion applied (bit=1 means True)
+        """
+        raise NotImplementedError
+
+
+class TextEncoder(PayloadEncoder):
+    """'{device_id} {object_type} {object_id} {value}', batch is newline separated."""
+
+    name = 'text'
+
+    def render(self, pin, value):  # -> bytes
+        return f'{pin.prefix}{int(value)}'.encode()
+
+    def encode_batch(self, pins_values):  # -> bytes
+        return b'\n'.join(pin.payloads[value] for pin, value in pins_values)
+
+    def encode_snapshot(self, bus, states, timestamp, seq):  # -> bytes
+        """'{device_id} {object_type} {bus_id} {seq} {timestamp} {value_0} ... {value_7}'"""
+        values = ' '.join('1' if states & pin.mask else '0' for pin in bus.pins)
+        return (f'{self._device_id} {bus.obj_type.id} {bus.bus_id} {seq} '
+                f'{timestamp:.3f} {values}').encode()
+
+
+class JsonEncoder(PayloadEncoder):
+    """JSON object per state, batch is a JSON array."""
+
+    name = 'json'
+
+    def render(self, pin, value):  # -> bytes
+        return dumps({'device_id': self._device_id,
+                      'object_type': pin.obj_type.id,
+                      'object_identifier': int(pin.obj_id),
+                      'value': int(value),
+                      }, separators=(',', ':')).encode()
+
+    def encode_batch(self, pins_values):  # -> bytes
+        return b'[' + b','.join(pin.payloads[value] for pin, value in pins_values) + b']'
+
+    def encode_snapshot(self, bus, states, timestamp, seq):  # -> bytes
+        return dumps({'device_id': self._device_id,
+                      'object_type': bus.obj_type.id,
+                      'bus': bus.bus_id,
+                      'seq': seq,
+                      'timestamp': round(timestamp, 3),
+                      'values': [1 if states & pin.mask else 0 for pin in bus.pins],
+                      }, separators=(',', ':')).encode()
+
+
+class BinaryEncoder(PayloadEncoder):
+    """Fixed 8 bytes per state (big-endian):
+    device_id uint32, object_type uint8, object_id uint16, value uint8.
+    Batch is a concatenation of records.
+    """
+
+    name = 'binary'
+    record = Struct('>IBHB')
+    # device_id uint32, object_type uint8, bus_id uint8, seq uint32,
+    # timestamp float64, states uint8 (bit per pin)
+    snapshot = Struct('>IBBIdB')
+
+    def render(self, pin, value):  # -> bytes
+        return self.record.pack(self._device_id, pin.obj_type.id, int(pin.obj_id),
+                                int(value))
+
+    def encode_batch(self, pins_values):  # -> bytes
+        return b''.join(pin.payloads[value] for pin, value in pins_values)
+
+    def encode_snapshot(self, bus, states, timestamp, seq):  # -> bytes
+        return self.snapshot.pack(self._device_id, bus.obj_type.id, bus.bus_id,
+                                  seq & 0xFFFFFFFF, timestamp, states)
+
+
+def get_encoder(name, device_id):  # -> PayloadEncoder
+    if name == TextEncoder.name:
+        return TextEncoder(device_id=device_id)
+    if name == JsonEncoder.name:
+        return JsonEncoder(device_id=device_id)
+    if name == BinaryEncoder.name:
+        return BinaryEncoder(device_id=device_id)
+    raise ValueError(f'Unknown payload encoding: {name}')
@@ -0,0 +1,166 @@
+import logging
+from threading import Event, RLock
+
+import paho.mqtt.client as mqtt
+
+_log = logging.getLogger(__name__)
+
+
+class LoopbackBroker:
+    """In-process broker stand-in.
+
+    Routes published messages to subscribed clients and keeps retained messages.
+    Messages are delivered synchronously in the publisher's thread.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._clients = []
+        self.retained = {}  # topic: MQTTMessage
+
+        self.published = 0
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def attach(self, client):
+        with self._lock:
+            if client not in self._clients:
+                self._clients.append(client)
+
+    def is_attached(self, client):  # -> bool
+        with self._lock:
+            return client in self._clients
+
+    def detach(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        # topic: str, payload: Union[str, bytes] = None, qos: int = 0,
+        # retain: bool = False) -> None:
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        elif isinstance(payload, (int, float)):
+            payload = str(payload).encode()
+
+        message = mqtt.MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        message.qos = qos
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(f'{topic}: {payload}')
+
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    message.retain = True
+                    self.retained[topic] = message
+                else:
+                    self.retained.pop(topic, None)
+            clients = list(self._clients)
+
+        for client in clients:
+            client.deliver(message=message)
+
+
+default_broker = LoopbackBroker()
+
+
+class LoopbackClient:
+    """Subset of `paho.mqtt.client.Client` working with `LoopbackBroker`.
+    Selected by `transport: loopback` in mqtt.yaml.
+    """
+
+    def __init__(self, broker: LoopbackBroker = None, userdata=None):
+        self.broker = broker or default_broker
+        self._userdata = userdata
+
+        self._subscriptions = {}  # topic filter: qos
+        self._mid = 0
+        self._disconnected = Event()
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.on_message = None
+        self.on_publish = None
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def _next_mid(self):  # -> int
+        self._mid += 1
+        return self._mid
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60, **kwargs):  # -> int
+        self._disconnected.clear()
+        self.broker.attach(client=self)
+        if self.on_connect is not None:
+            self.on_connect(self, self._userdata, {}, mqtt.CONNACK_ACCEPTED)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self):  # -> int
+        self.broker.detach(client=self)
+        self._subscriptions.clear()
+        self._disconnected.set()
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, self._userdata, mqtt.MQTT_ERR_SUCCESS)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_forever(self, timeout=1.0, max_packets=1, retry_first_connection=False):
+        # Messages are delivered by the broker, so only wait for disconnect.
+        self._disconnected.wait()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self, force=False):
+        pass
+
+    def subscribe(self, topic, qos=0):  # -> tuple[int, int]
+        topics = [(topic, qos)] if isinstance(topic, str) else topic
+        mid = self._next_mid()
+        for topic_filter, topic_qos in topics:
+            self._subscriptions[topic_filter] = topic_qos
+        if self.on_subscribe is not None:
+            self.on_subscribe(self, self._userdata, mid,
+                              tuple(topic_qos for _, topic_qos in topics))
+
+        for message in list(self.broker.retained.values()):
+            if any(mqtt.topic_matches_sub(topic_filter, message.topic)
+                   for topic_filter, _ in topics):
+                self.deliver(message=message)
+        return mqtt.MQTT_ERR_SUCCESS, mid
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        # -> mqtt.MQTTMessageInfo:
+        mid = self._next_mid()
+        info = mqtt.MQTTMessageInfo(mid=mid)
+        if not self.broker.is_attached(client=self):
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+
+        self.broker.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+        info._set_as_published()
+        if self.on_publish is not None:
+            self.on_publish(self, self._userdata, mid)
+        return info
+
+    def deliver(self, message):
+        # message: mqtt.MQTTMessage) -> None:
+        if self.on_message is None:
+            return
+        if any(mqtt.topic_matches_sub(topic_filter, message.topic)
+               for topic_filter in self._subscriptions):
+            self.on_message(self, self._userdata, message)
@@ -1,5 +1,10 @@
+import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import signal
 import sys
 from pathlib import Path
 
@@ -8,18 +13,45 @@ from mqtt import VisioMQTTClient
 _base_dir = Path(__file__).resolve().parent
 _yaml_path = _base_dir / 'mqtt.yaml'
 
+
+async def main(client):
+    # client: VisioMQTTClient) -> None:
+    # systemd stops the service with SIGTERM: the client disconnects from
+    # the broker and saves the state before the process exits
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, client.stop)
+    await client.run()
+
+
 if __name__ == '__main__':
     # Set logging
     _log_fmt = ('%(levelname)-8s [%(asctime)s] [%(threadName)s] %(name)s'
                 '.%(funcName)s(%(lineno)d): %(message)s'
                 )
-    _log_level = os.environ.get('LOG_LEVEL', 'DEBUG')
+    _log_level = os.environ.get('LOG_LEVEL', 'INFO')
     _log = logging.getLogger(__name__)
 
-    logging.basicConfig(format=_log_fmt,
-                        level=_log_level,
-                        stream=sys.stderr,
-                        )
+    if os.environ.get('LOG_QUEUE'):
+        # Records are formatted and written by a listener thread,
+        # so slow stderr (journald on SD card) does not block the poll loop.
+        _handler = logging.StreamHandler(stream=sys.stderr)
+        _handler.setFormatter(logging.Formatter(fmt=_log_fmt))
+        _queue = queue.SimpleQueue()
+        _queue_handler = logging.handlers.QueueHandler(_queue)
+        # message only, the full format is applied by the listener's handler
+        _queue_handler.setFormatter(logging.Formatter(fmt='%(message)s'))
+        logging.basicConfig(level=_log_level, handlers=[_queue_handler])
+        _listener = logging.handlers.QueueListener(_queue, _handler)
+        _listener.start()
+        atexit.register(_listener.stop)
+    else:
+        logging.basicConfig(format=_log_fmt,
+                            level=_log_level,
+                            stream=sys.stderr,
+                            )
 
     visio_mqtt_client = VisioMQTTClient.from_yaml(yaml_path=_yaml_path)
-    visio_mqtt_client.run()
+    # MQTT, polling, commands and publishing share one event loop,
+    # only blocking bus transactions run in threads (one per bus)
+    asyncio.run(main(client=visio_mqtt_client))
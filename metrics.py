@@ -0,0 +1,280 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from threading import Lock
+
+_log = logging.getLogger(__name__)
+
+# in seconds: from a single I2C transaction up to a stalled bus
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_value(value):  # -> str
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _finite(value):  # -> Optional[float]
+    return None if value == float('inf') else value
+
+
+def _format_labels(names, values, extra=()):  # -> str
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n') + '"' for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Value:
+    """Value of one label set of a counter or gauge."""
+
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        """Sets the value. For counters only to mirror an existing counter."""
+        self.value = value
+
+
+class _HistogramValue:
+    """Observations of one label set of a histogram."""
+
+    __slots__ = ('_bounds', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # per bucket, last is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):  # -> float
+        """Upper bound of the bucket holding the `q` quantile (0 if empty)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self._bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metric:
+    """Metric family: one value per set of label values."""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        # name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}  # label values: value
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Value of the label set. Hot paths should keep the result."""
+        if len(values) != len(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}, '
+                             f'got {values}')
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_value())
+        return child
+
+    def _samples(self):
+        # -> Iterator[tuple[str, str, float]]: suffix, labels, value
+        for values, child in list(self._children.items()):
+            yield '', _format_labels(self.label_names, values), child.value
+
+    def expose(self):  # -> str
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{self.name}{suffix}{labels} {_format_value(value)}'
+                     for suffix, labels, value in self._samples())
+        return '\n'.join(lines)
+
+    def as_dict(self):  # -> dict
+        return {','.join(map(str, values)) or self.name: child.value
+                for values, child in list(self._children.items())}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_value(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_value(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name=name, help=help, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(bounds=self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), child.counts):
+                cumulative += count
+                yield '_bucket', _format_labels(self.label_names, values,
+                                                extra=(('le', _format_value(bound)),)
+                                                ), cumulative
+            yield '_sum', _format_labels(self.label_names, values), child.sum
+            yield '_count', _format_labels(self.label_names, values), child.count
+
+    def as_dict(self):  # -> dict
+        return {','.join(map(str, values)) or self.name: {
+            'count': child.count,
+            'sum': child.sum,
+            # None if above the largest bucket (JSON has no Infinity)
+            'p50': _finite(child.quantile(0.5)),
+            'p99': _finite(child.quantile(0.99)),
+        } for values, child in list(self._children.items())}
+
+
+class MetricsRegistry:
+    """Named metrics of the panel.
+
+    Components create their metrics once and update them on their hot paths.
+    Values which are already counted elsewhere (outbox, debouncers, timers)
+    are copied in by collectors, called before every scrape.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = {}  # name: Metric
+        self._collectors = []
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self._metrics)})'
+
+    def _get_or_create(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name=name, help=help,
+                                                   labels=labels, **kwargs)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f'{name} is already registered as {metric}')
+        return metric
+
+    def counter(self, name, help, labels=()):  # -> Counter
+        return self._get_or_create(Counter, name=name, help=help, labels=labels)
+
+    def gauge(self, name, help, labels=()):  # -> Gauge
+        return self._get_or_create(Gauge, name=name, help=help, labels=labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):  # -> Histogram
+        return self._get_or_create(Histogram, name=name, help=help, labels=labels,
+                                   buckets=buckets)
+
+    def add_collector(self, fn):
+        # fn: Callable[[], None]) -> None:
+        self._collectors.append(fn)
+
+    def collect(self):
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception as e:
+                _log.warning(f'Metrics collector {fn} error: {e}',
+                             exc_info=True
+                             )
+
+    def expose(self):  # -> str
+        """All metrics in Prometheus text format."""
+        self.collect()
+        return '\n'.join(metric.expose() for metric in list(self._metrics.values())) + '\n'
+
+    def as_dict(self):  # -> dict
+        self.collect()
+        return {name: metric.as_dict() for name, metric in list(self._metrics.items())}
+
+
+async def serve_metrics(registry, host='127.0.0.1', port=9108):
+    # registry: MetricsRegistry, host: str = '127.0.0.1', port: int = 9108) -> None:
+    """Serves `GET /metrics` in Prometheus text format until cancelled."""
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # headers are not used, read up to the blank line
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            method, path, *_ = request_line.decode('latin-1').split() or ('', '')
+            if method == 'GET' and path.split('?')[0] in ('/metrics', '/'):
+                status, content_type = '200 OK', registry.CONTENT_TYPE
+                body = registry.expose().encode()
+            else:
+                status, content_type = '404 Not Found', 'text/plain'
+                body = b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: {content_type}\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            _log.debug(f'Metrics request error: {e}')
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host=host, port=port)
+    _log.info(f'Metrics served on http://{host}:{port}/metrics')
+    async with server:
+        await server.serve_forever()
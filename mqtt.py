@@ -1,11 +1,17 @@
+import asyncio
 import time
+from functools import partial
+from json import dumps
 from logging import getLogger
 from pathlib import Path
-from threading import Thread
+from threading import get_ident
 
 import paho.mqtt.client as mqtt
 
 from api import I2CConnector
+from dispatch import VALUE_SCHEMA, VALUES_SCHEMA, MessageDispatcher
+from metrics import MetricsRegistry
+from outbox import Outbox
 from result_code import ResultCode
 
 _log = getLogger(__name__)
@@ -15,10 +21,14 @@ _base_dir = Path(__file__).resolve().parent
 class VisioMQTTClient:  # (Thread):
     """Control interactions via MQTT."""
 
+    # seconds for DISCONNECT to be written on stop
+    disconnect_timeout = 5
+
     def __init__(self,
                  # gateway,
                  config: dict,
                  # getting_queue: SimpleQueue = None
+                 i2c_config: dict = None,
                  ):
         # """
         # :param gateway: Gateway or Panel
@@ -42,11 +52,48 @@ class VisioMQTTClient:  # (Thread):
 
         self._stopped = False
         self._connected = False
-
-        self._client = mqtt.Client(
-            transport='tcp',
-            # transport='websockets'
-        )
+        # Event loop of `run`. Asyncio primitives are created there,
+        # paho callbacks from other threads are passed to it.
+        self._loop = None
+        self._loop_thread = None
+        self._online = None  # asyncio.Event, set while the broker connection is up
+        self._disconnected = None  # asyncio.Event
+        self._stop_requested = None  # asyncio.Event
+        self._outbox_ready = None  # asyncio.Event
+        self._misc_task = None
+        self._reconnect_delay = self._config.get('reconnect_delay', 1)
+        self._reconnect_max_delay = self._config.get('reconnect_max_delay', 120)
+        # grows while connection attempts fail, reset by a successful CONNACK
+        self._retry_delay = self._reconnect_delay
+
+        # metrics of the whole panel, the I2C side registers its own here
+        self.metrics = MetricsRegistry()
+        published = self.metrics.counter('panel_mqtt_published_total',
+                                         'Messages handed to the MQTT client',
+                                         labels=('qos',))
+        self._published = {qos: published.labels(qos) for qos in (0, 1, 2)}
+        stats_cfg = self._config.get('stats') or {}
+        self._stats_topic = stats_cfg.get('topic')
+        self._stats_interval = stats_cfg.get('interval', 60)
+
+        # publishes made while the broker is unreachable
+        outbox_cfg = self._config.get('outbox') or {}
+        outbox_path = outbox_cfg.get('path')
+        self.outbox = Outbox(path=_base_dir / outbox_path if outbox_path else None,
+                             max_entries=outbox_cfg.get('max_entries', 1024),
+                             segment_size=outbox_cfg.get('segment_size', 1 << 20))
+        self._drain_rate = outbox_cfg.get('drain_rate', 50)
+        self._register_outbox_metrics()
+
+        transport = self._config.get('transport', 'tcp')
+        if transport == 'loopback':  # in-process broker stand-in
+            from loopback import LoopbackClient
+            self._client = LoopbackClient()
+        else:
+            self._client = mqtt.Client(
+                transport=transport,
+                # transport='websockets'
+            )
 
         # self._client.tls_set_context(ssl.SSLContext(ssl.PROTOCOL_TLSv1_2))
         # self._client.tls_set()
@@ -59,16 +106,32 @@ class VisioMQTTClient:  # (Thread):
         self._client.on_subscribe = self._on_subscribe_cb
         self._client.on_message = self._on_message_cb
         self._client.on_publish = self._on_publish_cb
-
-        self.api = I2CConnector.from_yaml(visio_mqtt_client=self,
-                                          yaml_path=_base_dir / 'i2c.yaml'
-                                          )
-        poll_tread = Thread(target=self.api.run, daemon=True)
-        poll_tread.start()
+        # the socket is served by the event loop instead of paho's own loop
+        self._client.on_socket_open = self._on_socket_open_cb
+        self._client.on_socket_close = self._on_socket_close_cb
+        self._client.on_socket_register_write = self._on_socket_register_write_cb
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write_cb
+
+        if i2c_config is None:
+            self.api = I2CConnector.from_yaml(visio_mqtt_client=self,
+                                              yaml_path=_base_dir / 'i2c.yaml'
+                                              )
+        else:
+            self.api = I2CConnector(visio_mqtt_client=self, config=i2c_config)
 
         # self.api.start()
         self.topics = [(topic, self._qos) for topic in self._config['subscribe']]
 
+        # RPC methods per subscribed topic
+        self.dispatcher = MessageDispatcher(device_id=self.device_id,
+                                            on_invalid=self.api.publish_error,
+                                            metrics=self.metrics)
+        for topic, _ in self.topics:
+            self.dispatcher.add(topic_filter=topic, method='value',
+                                handler=self.api.submit_rpc_value, schema=VALUE_SCHEMA)
+            self.dispatcher.add(topic_filter=topic, method='values',
+                                handler=self.api.submit_rpc_values, schema=VALUES_SCHEMA)
+
     def __repr__(self) -> str:
         return self.__class__.__name__
 
@@ -95,63 +158,148 @@ class VisioMQTTClient:  # (Thread):
             d[bus_id] = self._config['publish'][bus_id]['interval']
         return d
 
+    @property
+    def encoding(self):  # -> str
+        """Payload encoding of pin states: text, json or binary."""
+        return self._config.get('encoding', 'text')
+
+    @property
+    def error_topic(self):  # -> str
+        return self._config.get('error_topic', f'Error/{self.device_id}')
+
     @property
     def publish_topics(self):  # -> dict[int, dict]
         return self._config['publish']
 
-    def run(self):
-        """Main loop."""
-
-        while not self._stopped:  # not self._connected and
-            if self._connected:
-                self._run_loop()
-            else:
+    async def run(self):
+        """Main coroutine: broker connection, polling and publishing
+        share one event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = get_ident()
+        self._online = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._stop_requested = asyncio.Event()
+        self._outbox_ready = asyncio.Event()
+
+        tasks = [asyncio.create_task(self.api.run(), name='Polling'),
+                 asyncio.create_task(self._drain_outbox(), name='Outbox-drain')]
+        if self._stats_topic:
+            tasks.append(asyncio.create_task(self._publish_stats(), name='Stats-publish'))
+        try:
+            while not self._stopped:
                 try:
-                    self.connect(host=self._host,
-                                 port=self._port
-                                 )
-                except ConnectionRefusedError as e:
+                    await self.connect(host=self._host,
+                                       port=self._port
+                                       )
+                    await self._disconnected.wait()
+                except OSError as e:
                     _log.warning(f'Cannot connect to broker: {e}')
-                    time.sleep(10)
                 except Exception as e:
                     _log.error(f'Connection to broker error: {e}',
                                exc_info=True
                                )
-
-    def _run_loop(self):
-        """Designed as an endless loop. CAn be stopped from gateway thread."""
-        # self.subscribe(topics=self.topics)
-        while not self._stopped:
-            try:
-                time.sleep(60 * 5)
-
-            except Exception as e:
-                _log.warning(f'Receive-publish error: {e}',
-                             exc_info=True
-                             )
-        else:  # received stop signal
+                if not self._stopped:
+                    try:
+                        await asyncio.wait_for(self._stop_requested.wait(),
+                                               timeout=self._retry_delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._retry_delay = min(self._retry_delay * 2,
+                                            self._reconnect_max_delay)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.outbox.close()
+            self._loop = None
             _log.info(f'{self} stopped.')
 
+    def _call_in_loop(self, fn, *args):
+        """Calls `fn(*args)` now if in the event loop thread (or before `run`),
+        otherwise schedules the call in the loop.
+        """
+        if self._loop is None or get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
     def stop(self) -> None:
         self._stopped = True
         _log.info(f'Stopping {self} ...')
-        self.disconnect()
+        self._call_in_loop(self.disconnect)
+        if self._stop_requested is not None:
+            # also ends the wait before a reconnect
+            self._call_in_loop(self._stop_requested.set)
 
-    def connect(self, host, port=1883):
+    async def connect(self, host, port=1883):
         # host: str, port: int = 1883):
-        """Connect to broker."""
-        self._client.connect(host=host,
-                             port=port,
-                             )
-        self._client.reconnect_delay_set()
+        """Connect to broker. Returns when the connection is initiated,
+        `_disconnected` is set when it is lost.
+        """
+        self._disconnected.clear()
+        # DNS lookup and TCP connect block, so they are done in the default
+        # executor; socket hooks pass the new socket to the event loop.
+        await self._loop.run_in_executor(None, partial(self._client.connect,
+                                                       host=host,
+                                                       port=port,
+                                                       ))
         # self.subscribe(topics=self.topics)
-        self._client.loop_forever(retry_first_connection=True)
 
     def disconnect(self):
-        self._client.disconnect()
         _log.debug(f'{self._client} Disconnecting from broker')
         self._connected = False
-        self._client.loop_stop()
+        if self._client.disconnect() == mqtt.MQTT_ERR_NO_CONN:
+            # no socket, nothing to send
+            self._set_offline()
+        elif self._loop is not None:
+            # `_on_disconnect_cb` is called once DISCONNECT is written and the
+            # socket is closed; a broker which does not read is not waited for
+            self._loop.call_later(self.disconnect_timeout, self._set_offline)
+
+    def _set_offline(self):
+        if self._online is not None:
+            self._online.clear()
+            self._disconnected.set()
+
+    def _watch_socket(self, sock):
+        if self._loop is not None:
+            self._loop.add_reader(sock, self._client.loop_read)
+            self._misc_task = self._loop.create_task(self._run_misc(), name='MQTT-misc')
+
+    def _unwatch_socket(self, sock):
+        if self._loop is not None:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def _watch_writes(self, sock):
+        # paho has outgoing data which did not fit into the socket buffer
+        if self._loop is not None:
+            self._loop.add_writer(sock, self._client.loop_write)
+
+    def _unwatch_writes(self, sock):
+        if self._loop is not None:
+            self._loop.remove_writer(sock)
+
+    async def _run_misc(self):
+        """Keepalive pings and retries of unacknowledged messages."""
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_socket_open_cb(self, client, userdata, sock):
+        self._call_in_loop(self._watch_socket, sock)
+
+    def _on_socket_close_cb(self, client, userdata, sock):
+        self._call_in_loop(self._unwatch_socket, sock)
+
+    def _on_socket_register_write_cb(self, client, userdata, sock):
+        self._call_in_loop(self._watch_writes, sock)
+
+    def _on_socket_unregister_write_cb(self, client, userdata, sock):
+        self._call_in_loop(self._unwatch_writes, sock)
 
     def subscribe(self, topics):  # : Sequence[tuple[str, int]]):
         """
@@ -164,14 +312,80 @@ class VisioMQTTClient:  # (Thread):
         elif result == mqtt.MQTT_ERR_NO_CONN:
             _log.warning(f'Not subscribed to topic: {topics} {result} {mid}')
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
+    def publish(self, topic, payload=None, qos=0, retain=False, key=None):
         # topic: str, payload: str = None, qos: int = 0,
-        # retain: bool = False) -> mqtt.MQTTMessageInfo:
-        return self._client.publish(topic=topic,
-                                    payload=payload,
-                                    qos=qos,
-                                    retain=retain
-                                    )
+        # retain: bool = False, key: str = None) -> Optional[mqtt.MQTTMessageInfo]:
+        """Publishes now if the broker is connected and the outbox is empty,
+        otherwise (or if publish fails) stores the message in the outbox.
+
+        :param key: only the latest message per key is kept in the outbox
+        :return: message info or None if the message is stored
+        """
+        if self._online is not None and self._online.is_set() and not self.outbox:
+            info = self._client.publish(topic=topic,
+                                        payload=payload,
+                                        qos=qos,
+                                        retain=retain
+                                        )
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._published[qos].inc()
+                return info
+            _log.debug(f'Publish to {topic} failed: {info.rc}. Stored in outbox')
+        self.outbox.put(topic=topic, payload=payload, qos=qos, retain=retain, key=key)
+        if self._outbox_ready is not None:
+            self._call_in_loop(self._outbox_ready.set)
+        return None
+
+    async def _drain_outbox(self):
+        """Publishes stored messages while connected, oldest first,
+        at most `drain_rate` messages per second.
+        """
+        period = 1 / self._drain_rate
+        while not self._stopped:
+            await self._online.wait()
+            entry = self.outbox.peek(timeout=0)
+            if entry is None:
+                self._outbox_ready.clear()
+                await self._outbox_ready.wait()
+                continue
+            info = self._client.publish(topic=entry.topic,
+                                        payload=entry.payload,
+                                        qos=entry.qos,
+                                        retain=entry.retain
+                                        )
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._published[entry.qos].inc()
+                self.outbox.ack(entry=entry)
+                if not self.outbox:
+                    _log.info(f'Outbox drained: {self.outbox.as_dict()}')
+            else:
+                _log.warning(f'Outbox publish to {entry.topic} failed: {info.rc}')
+                await asyncio.sleep(1)
+            await asyncio.sleep(period)
+
+    def _register_outbox_metrics(self):
+        depth = self.metrics.gauge('panel_outbox_depth', 'Messages waiting in the outbox')
+        counters = {name: self.metrics.counter(f'panel_outbox_{name}_total',
+                                               f'Outbox messages {name}')
+                    for name in ('enqueued', 'coalesced', 'dropped', 'drained')}
+
+        def collect():
+            depth.set(self.outbox.depth)
+            for name, counter in counters.items():
+                counter.labels().set(getattr(self.outbox, name))
+
+        self.metrics.add_collector(collect)
+
+    async def _publish_stats(self):
+        """Publishes all metrics as one JSON message once per stats `interval`."""
+        while not self._stopped:
+            await asyncio.sleep(self._stats_interval)
+            self.publish(topic=self._stats_topic,
+                         payload=dumps({'device_id': self.device_id,
+                                        'timestamp': time.time(),
+                                        'metrics': self.metrics.as_dict(),
+                                        }),
+                         qos=0, retain=False, key='stats')
 
     def _on_publish_cb(self, client, userdata, mid):
         # _log.debug(f'Published: {client} {userdata} {mid}')
@@ -180,6 +394,8 @@ class VisioMQTTClient:  # (Thread):
     def _on_connect_cb(self, client, userdata, flags, rc, properties=None):
         if rc == ResultCode.CONNECTION_SUCCESSFUL.rc:
             self._connected = True
+            self._retry_delay = self._reconnect_delay
+            self._call_in_loop(self._online.set)
             _log.info('Successfully connected to broker')
             self.subscribe(topics=self.topics)
             # Subscribing in on_connect() means that if we lose the connection and
@@ -189,6 +405,7 @@ class VisioMQTTClient:  # (Thread):
 
     def _on_disconnect_cb(self, client, userdata, rc):
         # self._connected = False
+        self._call_in_loop(self._set_offline)
         _log.warning(f'Disconnected: {ResultCode(rc)}')
         # self._client.loop_stop()
 
@@ -204,24 +421,13 @@ class VisioMQTTClient:  # (Thread):
                        )
 
     def _on_message_cb(self, client, userdata, message):  #: mqtt.MQTTMessage):
-        msg_dct = self.api.decode(msg=message)
-        _log.debug(f'Received {message.topic}:{msg_dct}')
+        # commands are queued in the event loop
+        self._call_in_loop(self._handle_message, message)
+
+    def _handle_message(self, message):  #: mqtt.MQTTMessage):
         try:
-            if msg_dct['params'].get('device_id') == self._config['device_id']:
-                if msg_dct.get('method') == 'value':
-                    # TODO: ADD THREAD POOL
-                    rpc_value_tread = Thread(target=self.api.rpc_value_panel,
-                                             kwargs={'params': msg_dct['params']},
-                                             daemon=True
-                                             )
-                    rpc_value_tread.start()
-                    # rpc_value_tread.join()
-
-                    # todo: provide device_id and cache result (error) if device not polling
-                    # self.api.rpc_value_panel(params=msg_dct['params'],
-                    #                          # topic=message.topic,
-                    #                          )
+            self.dispatcher.dispatch(topic=message.topic, payload=message.payload)
         except Exception as e:
-            _log.warning(f'Error: {e} :{msg_dct}',
+            _log.warning(f'Error: {e} :{message.topic}',
                          exc_info=True
                          )
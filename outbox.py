@@ -0,0 +1,325 @@
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from struct import Struct
+from threading import Condition
+
+_log = logging.getLogger(__name__)
+
+
+class OutboxEntry:
+    __slots__ = ('key', 'seq', 'topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, key, seq, topic, payload, qos, retain):
+        self.key = key
+        self.seq = seq
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.key} seq={self.seq} topic={self.topic})'
+
+
+class SegmentLog:
+    """Append-only log of outbox entries in a memory-mapped file of fixed size.
+
+    Header keeps the sequence number of the last delivered entry, so records
+    with seq <= acked are skipped on recovery. When the segment is full, live
+    entries are compacted into a new file (`prepare`), which replaces the old
+    one (`install`).
+    """
+
+    # magic, acked seq
+    header = Struct('>4sQ')
+    # record length, seq, qos, retain, key length, topic length;
+    # then key, topic and payload bytes
+    record = Struct('>IQBBHH')
+    MAGIC = b'VPOB'
+
+    def __init__(self, path, size):
+        # path: Path, size: int) -> None:
+        self.path = Path(path)
+        self.size = size
+        self._file = None
+        self._map = None
+        self._offset = self.header.size
+        self.acked = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    def open(self):  # -> list[OutboxEntry]
+        """Maps the file, creating it if needed.
+
+        :return: undelivered entries of the previous run, latest per key, in order
+        """
+        entries = OrderedDict()
+        if self.path.exists() and self.path.stat().st_size == self.size:
+            self._map_file()
+            magic, self.acked = self.header.unpack_from(self._map, 0)
+            if magic == self.MAGIC:
+                for entry, end in self._scan():
+                    entries.pop(entry.key, None)
+                    if entry.seq > self.acked:
+                        entries[entry.key] = entry
+                    self._offset = end
+            else:
+                _log.warning(f'{self.path} is not an outbox segment. Recreated')
+                self._reset(entries=())
+        else:
+            self._reset(entries=())
+        if entries:
+            _log.info(f'Recovered {len(entries)} outbox entries from {self.path}')
+        return list(entries.values())
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def _map_file(self):
+        self.close()
+        self._file = self.path.open('r+b')
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    def _scan(self):
+        # -> Iterator[tuple[OutboxEntry, int]]:
+        offset = self.header.size
+        while offset + self.record.size <= self.size:
+            length, seq, qos, retain, key_len, topic_len = self.record.unpack_from(
+                self._map, offset)
+            if not length or offset + length > self.size:
+                return
+            start = offset + self.record.size
+            key = self._map[start:start + key_len].decode()
+            start += key_len
+            topic = self._map[start:start + topic_len].decode()
+            start += topic_len
+            payload = self._map[start:offset + length]
+            offset += length
+            yield OutboxEntry(key=key, seq=seq, topic=topic, payload=payload,
+                              qos=qos, retain=bool(retain)), offset
+
+    def _encode(self, entry):  # -> bytes
+        key = entry.key.encode()
+        topic = entry.topic.encode()
+        length = self.record.size + len(key) + len(topic) + len(entry.payload)
+        return (self.record.pack(length, entry.seq, entry.qos, entry.retain,
+                                 len(key), len(topic))
+                + key + topic + entry.payload)
+
+    def prepare(self, entries):
+        # entries: Iterable[OutboxEntry]) -> tuple[BinaryIO, mmap.mmap, int]:
+        """Writes `entries` into a new segment, which replaces the file on disk,
+        and maps it. The current map is not touched, so this can run in
+        another thread as long as nothing is appended meanwhile.
+
+        :return: segment for `install`
+        """
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        data = bytearray(self.size)
+        self.header.pack_into(data, 0, self.MAGIC, self.acked)
+        offset = self.header.size
+        for entry in entries:
+            record = self._encode(entry=entry)
+            if offset + len(record) > self.size:
+                break
+            data[offset:offset + len(record)] = record
+            offset += len(record)
+        with tmp_path.open('wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        file = self.path.open('r+b')
+        return file, mmap.mmap(file.fileno(), self.size), offset
+
+    def install(self, segment):
+        # segment: tuple[BinaryIO, mmap.mmap, int]) -> None:
+        """Switches to the segment made by `prepare`."""
+        if self._map is not None:
+            # already replaced on disk, nothing to flush
+            self._map.close()
+            self._file.close()
+        self._file, self._map, self._offset = segment
+        # acks made meanwhile
+        self.header.pack_into(self._map, 0, self.MAGIC, self.acked)
+
+    def _reset(self, entries):
+        """Writes `entries` into a new segment, which replaces the current one."""
+        self.install(segment=self.prepare(entries=entries))
+
+    def append(self, entry):  # -> bool
+        # entry: OutboxEntry) -> bool:
+        """:return: False if the segment is full
+        :raise ValueError: if the entry does not fit even into an empty segment
+        """
+        record = self._encode(entry=entry)
+        if self._offset + len(record) > self.size:
+            if self.header.size + len(record) > self.size:
+                raise ValueError(f'{entry} is larger than segment size {self.size}')
+            return False
+        self._map[self._offset:self._offset + len(record)] = record
+        self._offset += len(record)
+        return True
+
+    def ack(self, seq):
+        self.acked = seq
+        self.header.pack_into(self._map, 0, self.MAGIC, seq)
+
+
+class Outbox:
+    """Bounded store of publishes which could not be sent.
+
+    Entries are coalesced by key, so only the latest state of a pin is kept.
+    Entries without key are never coalesced. When `max_entries` is reached,
+    the oldest entry is dropped. With `path` set, entries are also written to
+    a memory-mapped segment log and survive restarts. A full segment is
+    compacted in a separate thread, so `put` does not wait for the disk.
+    """
+
+    def __init__(self, path=None, max_entries=1024, segment_size=1 << 20):
+        # path: Path = None, max_entries: int = 1024,
+        # segment_size: int = 1 << 20) -> None:
+        self.max_entries = max_entries
+
+        self._cond = Condition()
+        self._entries = OrderedDict()  # key: OutboxEntry, oldest first
+        self._seq = 0
+
+        self._log = SegmentLog(path=path, size=segment_size) if path else None
+        self._compactor = None
+        self._compacting = False
+        self._backlog = []  # entries put while the segment is compacted
+        if self._log is not None:
+            self._compactor = ThreadPoolExecutor(max_workers=1,
+                                                 thread_name_prefix='Outbox-compact')
+            for entry in self._log.open():
+                self._entries[entry.key] = entry
+                self._seq = max(self._seq, entry.seq)
+            self._seq = max(self._seq, self._log.acked)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.drained = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(depth={self.depth})'
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def depth(self):  # -> int
+        return len(self._entries)
+
+    def put(self, topic, payload, qos=0, retain=False, key=None):
+        # topic: str, payload: Union[str, bytes], qos: int = 0,
+        # retain: bool = False, key: str = None) -> None:
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        with self._cond:
+            self._seq += 1
+            if key is None:
+                key = f'#{self._seq}'
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.coalesced += 1
+                # latest state with the strongest delivery of replaced ones
+                qos = max(qos, old.qos)
+                retain = retain or old.retain
+            elif len(self._entries) >= self.max_entries:
+                dropped_key, _ = self._entries.popitem(last=False)
+                self.dropped += 1
+                _log.warning(f'Outbox is full. Dropped {dropped_key}')
+            entry = OutboxEntry(key=key, seq=self._seq, topic=topic, payload=payload,
+                                qos=qos, retain=retain)
+            if self._log is not None:
+                self._append_to_log(entry=entry)
+            self._entries[key] = entry
+            self.enqueued += 1
+            self._cond.notify_all()
+
+    def _append_to_log(self, entry):
+        # Called with the lock held.
+        if self._compacting:
+            self._backlog.append(entry)
+            return
+        try:
+            if self._log.append(entry=entry):
+                return
+        except ValueError as e:
+            _log.warning(f'{e}. Kept in memory only')
+            return
+        self._backlog.append(entry)
+        self._compacting = True
+        self._compactor.submit(self._compact, entries=list(self._entries.values()))
+
+    def _compact(self, entries):
+        # Executed in the compactor thread. The new segment is written and
+        # synced without the lock, then live entries put meanwhile are appended.
+        try:
+            segment = self._log.prepare(entries=entries)
+            with self._cond:
+                self._log.install(segment=segment)
+                for entry in self._backlog:
+                    if self._entries.get(entry.key) is entry and not self._log.append(
+                            entry=entry):
+                        _log.warning(f'{entry} does not fit into compacted outbox '
+                                     f'segment. Kept in memory only')
+        except (OSError, ValueError) as e:
+            _log.warning(f'Cannot compact {self._log}: {e}. '
+                         f'New entries are kept in memory only')
+        finally:
+            with self._cond:
+                self._backlog.clear()
+                self._compacting = False
+
+    def peek(self, timeout=None):  # -> Optional[OutboxEntry]
+        """Oldest entry, waits up to `timeout` seconds if there are none."""
+        with self._cond:
+            if not self._entries:
+                self._cond.wait(timeout=timeout)
+            if not self._entries:
+                return None
+            return next(iter(self._entries.values()))
+
+    def ack(self, entry):
+        # entry: OutboxEntry) -> None:
+        """Removes the delivered entry, unless it was replaced by a newer one."""
+        with self._cond:
+            current = self._entries.get(entry.key)
+            if current is not None and current.seq == entry.seq:
+                del self._entries[entry.key]
+            self.drained += 1
+            if self._log is not None:
+                self._log.ack(seq=entry.seq)
+
+    def close(self):
+        if self._compactor is not None:
+            # the running compaction is finished first
+            self._compactor.shutdown(wait=True)
+        with self._cond:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def as_dict(self):  # -> dict
+        return {'depth': self.depth,
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'drained': self.drained,
+                }
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+_log = logging.getLogger(__name__)
+
+
+class PulseScheduler:
+    """Owner of all pending pulse reverts, as timers of the event loop.
+
+    There is at most one pending event per key (bus_id, pin_id): scheduling
+    a key again moves its deadline (extends the pulse), `cancel` drops it.
+    Callbacks are executed in the event loop, so they must be short
+    (e.g. submit the revert command to a dispatcher).
+    """
+
+    def __init__(self):
+        self._pending = {}  # key: asyncio.TimerHandle
+
+        self.fired = 0
+        self.cancelled = 0
+        self.max_lateness = 0.0
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, key, delay, fn, **kwargs):
+        # key: tuple, delay: float, fn: Callable, **kwargs) -> None:
+        """Calls `fn(**kwargs)` after delay. Replaces pending event of the key.
+        Called in the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        self._drop(key=key)
+        # loop time is monotonic
+        self._pending[key] = loop.call_at(loop.time() + delay, self._fire, key, fn, kwargs)
+
+    def cancel(self, key):  # -> bool
+        """Cancels pending event of the key. Returns True if it was pending."""
+        return self._drop(key=key)
+
+    def _drop(self, key):  # -> bool
+        handle = self._pending.pop(key, None)
+        if handle is None:
+            return False
+        handle.cancel()
+        self.cancelled += 1
+        return True
+
+    def is_pending(self, key):  # -> bool
+        return key in self._pending
+
+    def stop(self):
+        for handle in self._pending.values():
+            handle.cancel()
+        self._pending.clear()
+        _log.info(f'{self} stopped.')
+
+    def _fire(self, key, fn, kwargs):
+        handle = self._pending.pop(key)
+        lateness = asyncio.get_running_loop().time() - handle.when()
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        self.fired += 1
+        try:
+            fn(**kwargs)
+        except Exception as e:
+            _log.warning(f'Pulse {key} callback error: {e}',
+                         exc_info=True
+                         )
+
+    def as_dict(self):  # -> dict
+        return {'pending': len(self._pending),
+                'fired': self.fired,
+                'cancelled': self.cancelled,
+                'max_lateness': self.max_lateness,
+                }
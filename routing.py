@@ -0,0 +1,184 @@
+import logging
+
+from obj_type import ObjType
+
+_log = logging.getLogger(__name__)
+
+PINS_PER_BUS = 8
+
+# how inputs of bi_bus are detected
+MODE_POLL = 'poll'
+MODE_INTERRUPT = 'interrupt'
+
+
+class PinRecord:
+    """Everything needed to read, write and publish one pin."""
+
+    __slots__ = ('bus_id', 'pin_id', 'mask', 'obj_type', 'obj_id',
+                 'topic', 'default', 'pulse_delay', 'inverted', 'debounce',
+                 'debounce_time', 'prefix', 'payloads',
+                 )
+
+    def __init__(self, bus_id, pin_id, obj_type, topic, default, pulse_delay,
+                 inverted, device_id, debounce=None, debounce_time=None):
+        self.bus_id = bus_id
+        self.pin_id = pin_id
+        self.mask = 1 << pin_id
+        self.obj_type = obj_type
+        self.obj_id = f'{bus_id}0{pin_id}'
+        self.topic = topic
+        self.default = default
+        self.pulse_delay = pulse_delay
+        self.inverted = inverted
+        # input filter: stable samples and seconds before a change is accepted
+        self.debounce = debounce
+        self.debounce_time = debounce_time
+        # payload without value: '{device_id} {object_type} {object_id} '
+        self.prefix = f'{device_id} {obj_type.id} {self.obj_id} '
+        # ready to send payloads of states: (False, True). Set by PayloadEncoder
+        self.payloads = None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.obj_id} topic={self.topic})'
+
+
+class BusRecord:
+    """Compiled configuration of one bus."""
+
+    __slots__ = ('bus_id', 'obj_type', 'topic', 'realtime_interval', 'mqtt_interval',
+                 'max_interval', 'backoff', 'deadline_policy', 'snapshot', 'mode',
+                 'int_pin', 'safety_interval', 'invert_mask', 'pins',
+                 )
+
+    def __init__(self, bus_id, obj_type, topic, realtime_interval, mqtt_interval,
+                 snapshot, pins, mode=MODE_POLL, int_pin=None, safety_interval=None,
+                 max_interval=None, backoff=2.0, deadline_policy='skip'):
+        self.bus_id = bus_id
+        self.obj_type = obj_type
+        self.topic = topic
+        self.realtime_interval = realtime_interval
+        self.mqtt_interval = mqtt_interval
+        # adaptive polling: realtime_interval after a change, backs off
+        # toward max_interval while quiet (None - fixed interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # when polls fall behind: 'skip' missed deadlines or 'catch_up'
+        self.deadline_policy = deadline_policy
+        # interrupt mode: GPIO of the INT line and interval of fallback polling
+        self.mode = mode
+        self.int_pin = int_pin
+        self.safety_interval = safety_interval
+        # periodic publish of all pins as one message on the bus topic
+        self.snapshot = snapshot
+        self.pins = pins  # tuple of PinRecord, index is pin_id
+
+        # bits of pins where low level means True
+        self.invert_mask = 0
+        for pin in pins:
+            if pin.inverted:
+                self.invert_mask |= pin.mask
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.bus_id} {self.obj_type})'
+
+
+class RoutingTable:
+    """Pin configuration compiled once at startup, so hot paths do not look up
+    the raw YAML.
+    """
+
+    def __init__(self, buses):
+        self._buses = buses  # bus_id: BusRecord
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self._buses)})'
+
+    def __contains__(self, bus_id):
+        return bus_id in self._buses
+
+    def __iter__(self):
+        return iter(self._buses.values())
+
+    def bus(self, bus_id):  # -> BusRecord
+        return self._buses[bus_id]
+
+    def pin(self, bus_id, pin_id):  # -> PinRecord
+        return self._buses[bus_id].pins[pin_id]
+
+    @classmethod
+    def compile(cls, device_id, i2c_config, publish_config, encoder):
+        # device_id: int, i2c_config: dict, publish_config: dict,
+        # encoder: PayloadEncoder) -> RoutingTable:
+        """
+        :param i2c_config: content of i2c.yaml
+        :param publish_config: 'publish' section of mqtt.yaml
+        :param encoder: pre-renders payloads of every pin
+        """
+        buses = {}
+        for section, obj_type in (('bi_buses', ObjType.BINARY_INPUT),
+                                  ('bo_buses', ObjType.BINARY_OUTPUT)):
+            for bus_id, bus_cfg in (i2c_config.get(section) or {}).items():
+                bus_cfg = bus_cfg or {}
+                pub_cfg = publish_config.get(bus_id) or {}
+                pin_topics = pub_cfg.get('pin_topic') or {}
+                bus_topic = pub_cfg.get('bus_topic')
+                if bus_topic is None and not pin_topics:
+                    _log.warning(f'Bus: {bus_id} has no topics in publish config. '
+                                 f'Its values will not be published')
+
+                # pulse delays are read from 'delay' in older configs
+                pulse_delays = bus_cfg.get('pulse_delay', bus_cfg.get('delay')) or {}
+
+                pins = tuple(
+                    PinRecord(bus_id=bus_id,
+                              pin_id=pin_id,
+                              obj_type=obj_type,
+                              topic=pin_topics.get(pin_id) or bus_topic,
+                              default=cls._per_pin(bus_cfg.get('default'), pin_id),
+                              pulse_delay=pulse_delays.get(pin_id) or 0,
+                              inverted=cls._per_pin(bus_cfg.get('inverted', True),
+                                                    pin_id),
+                              device_id=device_id,
+                              debounce=cls._per_pin(bus_cfg.get('debounce'), pin_id),
+                              debounce_time=cls._per_pin(bus_cfg.get('debounce_time'),
+                                                         pin_id)
+                              )
+                    for pin_id in range(PINS_PER_BUS))
+                for pin in pins:
+                    encoder.prepare(pin=pin)
+
+                mode = bus_cfg.get('mode', MODE_POLL)
+                if mode not in (MODE_POLL, MODE_INTERRUPT):
+                    raise ValueError(f'Bus: {bus_id} unknown mode: {mode}')
+                if mode == MODE_INTERRUPT and obj_type is not ObjType.BINARY_INPUT:
+                    raise ValueError(f'Bus: {bus_id} interrupt mode is for bi_buses only')
+
+                buses[bus_id] = BusRecord(
+                    bus_id=bus_id,
+                    obj_type=obj_type,
+                    topic=bus_topic,
+                    realtime_interval=bus_cfg.get('realtime_interval'),
+                    mqtt_interval=pub_cfg.get('interval'),
+                    snapshot=bool(pub_cfg.get('snapshot', False)) and bus_topic is not None,
+                    pins=pins,
+                    mode=mode,
+                    int_pin=bus_cfg.get('int_pin'),
+                    safety_interval=bus_cfg.get('safety_interval', 5),
+                    max_interval=bus_cfg.get('max_interval'),
+                    backoff=bus_cfg.get('backoff', 2.0),
+                    deadline_policy=bus_cfg.get('deadline_policy',
+                                                i2c_config.get('deadline_policy', 'skip'))
+                )
+        table = cls(buses=buses)
+        _log.debug(f'Compiled {table}')
+        return table
+
+    @staticmethod
+    def _per_pin(value, pin_id):
+        # Value can be set for the whole bus or as {bus: ..., <pin_id>: ...}
+        if not isinstance(value, dict):
+            return value
+        pin_value = value.get(pin_id)
+        if pin_value is None:
+            pin_value = value.get('bus')
+        return pin_value
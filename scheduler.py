@@ -0,0 +1,285 @@
+import asyncio
+from time import monotonic, time
+
+
+class BusStats:
+    """Polling statistics of one bus."""
+
+    __slots__ = ('bus_id', 'cycles', 'missed_deadlines',
+                 'last_cycle_time', 'max_cycle_time', 'total_cycle_time',
+                 'interval', 'started_at', 'last_polled_at', 'timer',
+                 '_window_cycles', '_window_missed', '_window_total', '_window_max',
+                 )
+
+    def __init__(self, bus_id):
+        self.bus_id = bus_id
+
+        self.cycles = 0
+        self.missed_deadlines = 0
+        self.interval = None  # effective poll interval of the last cycle
+        self.started_at = time()
+        self.timer = None  # DeadlineTimer of the poll loop
+
+        # counters since the last `summary`
+        self._window_cycles = 0
+        self._window_missed = 0
+        self._window_total = 0.0
+        self._window_max = 0.0
+
+        self.last_cycle_time = 0.0
+        self.max_cycle_time = 0.0
+        self.total_cycle_time = 0.0
+        self.last_polled_at = None
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(bus={self.bus_id} cycles={self.cycles} '
+                f'last={round(self.last_cycle_time, ndigits=4)} '
+                f'avg={round(self.avg_cycle_time, ndigits=4)} '
+                f'max={round(self.max_cycle_time, ndigits=4)} '
+                f'missed={self.missed_deadlines} rate={round(self.rate, ndigits=2)})')
+
+    @property
+    def avg_cycle_time(self):  # -> float
+        if not self.cycles:
+            return 0.0
+        return self.total_cycle_time / self.cycles
+
+    @property
+    def rate(self):  # -> float
+        """Current poll rate, cycles per second."""
+        if not self.interval:
+            return 0.0
+        return 1 / self.interval
+
+    @property
+    def avg_rate(self):  # -> float
+        """Poll rate since start, cycles per second."""
+        if self.last_polled_at is None or self.last_polled_at <= self.started_at:
+            return 0.0
+        return self.cycles / (self.last_polled_at - self.started_at)
+
+    def record(self, cycle_time, interval):
+        # cycle_time: float, interval: float) -> None:
+        """Registers one poll cycle. Cycle longer than interval is a missed deadline."""
+        self.cycles += 1
+        self.interval = interval
+        self.last_cycle_time = cycle_time
+        self.total_cycle_time += cycle_time
+        if cycle_time > self.max_cycle_time:
+            self.max_cycle_time = cycle_time
+        if cycle_time > interval:
+            self.missed_deadlines += 1
+            self._window_missed += 1
+        self._window_cycles += 1
+        self._window_total += cycle_time
+        if cycle_time > self._window_max:
+            self._window_max = cycle_time
+        self.last_polled_at = time()
+
+    def summary(self, period):  # -> str
+        """One line of stats since the previous summary, which restarts the window.
+
+        :param period: seconds since the previous summary
+        """
+        cycles = self._window_cycles
+        avg = self._window_total / cycles if cycles else 0.0
+        line = (f'Bus: {self.bus_id} {cycles} cycles in {round(period)} sec '
+                f'({round(cycles / period, ndigits=2) if period else 0.0}/sec) '
+                f'avg {avg * 1000:.2f} ms max {self._window_max * 1000:.2f} ms '
+                f'missed {self._window_missed}')
+        if self.timer is not None:
+            line += (f' skipped {self.timer.skipped} '
+                     f'jitter max {self.timer.max_jitter * 1000:.2f} ms')
+        self._window_cycles = self._window_missed = 0
+        self._window_total = self._window_max = 0.0
+        return line
+
+    def as_dict(self):  # -> dict
+        return {'bus_id': self.bus_id,
+                'timing': self.timer.as_dict() if self.timer is not None else None,
+                'cycles': self.cycles,
+                'missed_deadlines': self.missed_deadlines,
+                'last_cycle_time': self.last_cycle_time,
+                'avg_cycle_time': self.avg_cycle_time,
+                'max_cycle_time': self.max_cycle_time,
+                'interval': self.interval,
+                'rate': self.rate,
+                'avg_rate': self.avg_rate,
+                'last_polled_at': self.last_polled_at,
+                }
+
+
+class AdaptiveInterval:
+    """Poll interval of a bus, which follows input activity.
+
+    Drops to `floor` after a change, while the bus is quiet grows
+    by `backoff` times per cycle up to `ceiling`.
+    """
+
+    __slots__ = ('floor', 'ceiling', 'backoff', 'current')
+
+    def __init__(self, floor, ceiling=None, backoff=2.0):
+        # floor: float, ceiling: float = None, backoff: float = 2.0) -> None:
+        if ceiling is None or ceiling < floor:
+            ceiling = floor
+        if backoff < 1:
+            raise ValueError(f'Backoff must be >= 1, got {backoff}')
+        self.floor = floor
+        self.ceiling = ceiling
+        self.backoff = backoff
+        self.current = floor
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.floor}..{self.ceiling} '
+                f'current={round(self.current, ndigits=4)})')
+
+    @property
+    def adaptive(self):  # -> bool
+        return self.ceiling > self.floor
+
+    def update(self, changed):  # -> float
+        """:return: interval until the next poll"""
+        if changed:
+            self.current = self.floor
+        elif self.current < self.ceiling:
+            self.current = min(self.current * self.backoff, self.ceiling)
+        return self.current
+
+
+class DeadlineTimer:
+    """Fixed-rate deadlines on the monotonic clock.
+
+    Every deadline is the previous one plus the interval, so time spent in
+    the cycle and sleep overshoot do not accumulate. When the schedule falls
+    behind by more than an interval:
+        catch_up - missed deadlines are served back-to-back
+        skip - missed deadlines are dropped, the grid is kept
+    Jitter is how late `wait` returns after the deadline.
+    """
+
+    CATCH_UP = 'catch_up'
+    SKIP = 'skip'
+
+    __slots__ = ('interval', 'policy', 'deadline', '_clock', '_sleep',
+                 'ticks', 'overruns', 'skipped',
+                 'last_jitter', 'max_jitter', 'total_jitter',
+                 )
+
+    def __init__(self, interval, policy=SKIP, start=None, clock=monotonic,
+                 sleep=asyncio.sleep):
+        # interval: float, policy: str = SKIP, start: float = None,
+        # clock: Callable[[], float] = monotonic,
+        # sleep: Callable[[float], Awaitable] = asyncio.sleep) -> None:
+        """:param start: first deadline on `clock` (default: now)
+        :param sleep: coroutine sleeping on `clock`
+        """
+        if policy not in (self.CATCH_UP, self.SKIP):
+            raise ValueError(f'Unknown missed deadline policy: {policy}')
+        self.interval = interval
+        self.policy = policy
+        self._clock = clock
+        self._sleep = sleep
+        self.deadline = clock() if start is None else start
+
+        self.ticks = 0
+        self.overruns = 0  # deadlines already passed when scheduled
+        self.skipped = 0
+
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.interval} {self.policy} '
+                f'ticks={self.ticks} skipped={self.skipped} '
+                f'max_jitter={round(self.max_jitter, ndigits=4)})')
+
+    @property
+    def avg_jitter(self):  # -> float
+        if not self.ticks:
+            return 0.0
+        return self.total_jitter / self.ticks
+
+    def remaining(self):  # -> float
+        return max(self.deadline - self._clock(), 0.0)
+
+    def expired(self):  # -> bool
+        return self._clock() >= self.deadline
+
+    def advance(self, interval=None):  # -> int
+        """Schedules the next deadline.
+
+        :param interval: new interval, from this deadline on
+        :return: number of skipped deadlines
+        """
+        if interval is not None:
+            self.interval = interval
+        self.deadline += self.interval
+        now = self._clock()
+        if self.deadline >= now:
+            return 0
+        self.overruns += 1
+        if self.policy == self.CATCH_UP:
+            return 0
+        missed = int((now - self.deadline) // self.interval) + 1
+        self.deadline += missed * self.interval
+        self.skipped += missed
+        return missed
+
+    def tick(self):  # -> float
+        """Registers the deadline as served.
+
+        :return: jitter, seconds after the deadline
+        """
+        jitter = self._clock() - self.deadline
+        self.ticks += 1
+        self.last_jitter = jitter
+        self.total_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+        return jitter
+
+    async def wait(self):  # -> float
+        """Sleeps until the deadline. :return: jitter"""
+        delay = self.deadline - self._clock()
+        if delay > 0:
+            await self._sleep(delay)
+        return self.tick()
+
+    def as_dict(self):  # -> dict
+        return {'interval': self.interval,
+                'policy': self.policy,
+                'ticks': self.ticks,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'last_jitter': self.last_jitter,
+                'avg_jitter': self.avg_jitter,
+                'max_jitter': self.max_jitter,
+                }
+
+
+class SimulatedClock:
+    """Clock for timing checks: `sleep` advances it instantly.
+
+    Optional `lateness(delay) -> float` adds oversleep to every sleep,
+    to model a busy event loop or a stalled process.
+    """
+
+    def __init__(self, start=0.0, lateness=None):
+        self.now = start
+        self._lateness = lateness
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.now})'
+
+    def __call__(self):  # -> float
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    async def sleep(self, delay):
+        if self._lateness is not None:
+            delay += self._lateness(delay)
+        self.now += max(delay, 0.0)
+        await asyncio.sleep(0)
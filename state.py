@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from pathlib import Path
+from time import monotonic, time
+
+_log = logging.getLogger(__name__)
+
+
+class StateStore:
+    """Last known port bytes of buses, kept on disk for warm restarts.
+
+    Input ports let the first poll publish only real changes, output latches
+    let outputs start in their last commanded state. The file is replaced
+    atomically and written at most once per `min_interval` seconds.
+    """
+
+    def __init__(self, path, min_interval=1.0):
+        # path: Path, min_interval: float = 1.0) -> None:
+        self.path = Path(path)
+        self.min_interval = min_interval
+
+        self.inputs = {}  # bus_id: port byte
+        self.outputs = {}  # bus_id: port byte
+        self._dirty = False
+        self._saved_at = None  # monotonic
+
+        self.saves = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path})'
+
+    def load(self):  # -> bool
+        """:return: True if a snapshot was loaded"""
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+            self.inputs = {int(bus_id): port for bus_id, port in data['inputs'].items()}
+            self.outputs = {int(bus_id): port for bus_id, port in data['outputs'].items()}
+        except FileNotFoundError:
+            _log.info(f'No state snapshot {self.path}. Cold start')
+            return False
+        except (OSError, LookupError, TypeError, ValueError) as e:
+            _log.warning(f'Cannot load state snapshot {self.path}: {e}. Cold start')
+            return False
+        _log.info(f'Loaded state snapshot {self.path} saved at {data.get("saved_at")}')
+        return True
+
+    def set_input(self, bus_id, port):
+        if self.inputs.get(bus_id) != port:
+            self.inputs[bus_id] = port
+            self._dirty = True
+
+    def set_output(self, bus_id, port):
+        if self.outputs.get(bus_id) != port:
+            self.outputs[bus_id] = port
+            self._dirty = True
+
+    @property
+    def dirty(self):  # -> bool
+        return self._dirty
+
+    def due(self):  # -> bool
+        """True if there are unsaved changes and `min_interval` has passed."""
+        return self._dirty and (self._saved_at is None
+                                or monotonic() - self._saved_at >= self.min_interval)
+
+    def save(self):
+        """Writes the snapshot to a temporary file and replaces the old one."""
+        self._dirty = False
+        self._saved_at = monotonic()
+        data = {'saved_at': time(),
+                'inputs': dict(self.inputs),
+                'outputs': dict(self.outputs),
+                }
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            with tmp_path.open('w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.saves += 1
+        except OSError as e:
+            self._dirty = True
+            _log.warning(f'Cannot save state snapshot {self.path}: {e}')
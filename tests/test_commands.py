@@ -0,0 +1,101 @@
+"""Ordering, coalescing and confirmations of `CommandDispatcher`."""
+import asyncio
+
+import pytest
+
+from commands import CommandDispatcher, CommandQueueFull
+
+WINDOW = 0.05
+
+
+class Recorder:
+    """Stub command: records its name when executed and when confirmed."""
+
+    def __init__(self):
+        self.executed = []  # names of executed commands
+        self.confirmed = []  # names of called confirmations
+
+    async def __call__(self, name, gate=None):
+        if gate is not None:
+            await gate.wait()
+        self.executed.append(name)
+        return lambda: self.confirmed.append(name)
+
+
+async def drained(commands):
+    while commands.pending:
+        await asyncio.sleep(0.001)
+
+
+def test_burst_is_coalesced():
+    commands = CommandDispatcher(coalesce_window=WINDOW)
+    fn = Recorder()
+
+    async def drive():
+        seqs = [commands.submit((37, 1), fn, coalesce=True, name=f'value={value}')
+                for value in (1, 0, 1)]
+        await drained(commands)
+        return seqs
+
+    assert asyncio.run(drive()) == [1, 2, 3]
+    assert fn.executed == ['value=1']
+    # the replaced commands are confirmed without a publish
+    assert fn.confirmed == ['value=1']
+    assert commands.as_dict()['coalesced'] == 2
+    assert commands.as_dict()['unconfirmed'] == 0
+
+
+def test_confirmations_in_seq_order():
+    commands = CommandDispatcher()
+    fn = Recorder()
+
+    async def drive():
+        gate = asyncio.Event()
+        commands.submit((37, 1), fn, name='slow', gate=gate)
+        commands.submit((37, 2), fn, name='fast')
+        while fn.executed != ['fast']:
+            await asyncio.sleep(0.001)
+        # done, but waits for the earlier command
+        assert fn.confirmed == []
+        gate.set()
+        await drained(commands)
+
+    asyncio.run(drive())
+    assert fn.executed == ['fast', 'slow']
+    assert fn.confirmed == ['slow', 'fast']
+
+
+def test_batch_after_waiting_value():
+    commands = CommandDispatcher(coalesce_window=WINDOW)
+    fn = Recorder()
+
+    async def drive():
+        commands.submit((37, 1), fn, coalesce=True, name='value')
+        # the value command is still in its intake window
+        commands.submit([(37, 1), (37, 2)], fn, name='values')
+        await drained(commands)
+
+    asyncio.run(drive())
+    assert fn.executed == ['value', 'values']
+    assert fn.confirmed == ['value', 'values']
+
+
+def test_rejection_leaves_no_seq_gap():
+    commands = CommandDispatcher(max_queue_depth=1)
+    fn = Recorder()
+
+    async def drive():
+        gate = asyncio.Event()
+        assert commands.submit((37, 1), fn, name='first', gate=gate) == 1
+        with pytest.raises(CommandQueueFull):
+            commands.submit((37, 1), fn, name='rejected')
+        with pytest.raises(CommandQueueFull):
+            commands.submit([(37, 2), (37, 1)], fn, name='rejected batch')
+        assert commands.submit((37, 2), fn, name='second') == 2
+        gate.set()
+        await drained(commands)
+
+    asyncio.run(drive())
+    assert fn.confirmed == ['first', 'second']
+    assert commands.as_dict()['rejected'] == 2
+    assert commands.as_dict()['unconfirmed'] == 0
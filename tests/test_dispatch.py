@@ -0,0 +1,95 @@
+"""'value' messages from the RPC topic to the confirmation publish."""
+import asyncio
+from json import dumps, loads
+
+import pytest
+
+from mqtt import VisioMQTTClient
+
+DEVICE_ID = 666
+BI_BUS = 30
+BO_BUS = 37
+TOPIC = 'Set/yard/panel'
+
+
+@pytest.fixture
+def client():
+    mqtt_cfg = {'device_id': DEVICE_ID,
+                'host': 'loopback',
+                'port': 1883,
+                'transport': 'loopback',
+                'username': None,
+                'password': None,
+                'subscribe': ['Set/yard/#'],
+                'publish': {bus_id: {'interval': 3600,
+                                     'pin_topic': {pin_id: f'Pin/{bus_id}/{pin_id}'
+                                                   for pin_id in range(8)},
+                                     }
+                            for bus_id in (BI_BUS, BO_BUS)},
+                }
+    i2c_cfg = {'backend': 'simulated',
+               'bi_buses': {BI_BUS: {'realtime_interval': 0.1}},
+               'bo_buses': {BO_BUS: {'default': {'bus': False}}},
+               }
+    client = VisioMQTTClient(config=mqtt_cfg, i2c_config=i2c_cfg)
+    yield client
+    client.api.io.shutdown()
+
+
+def dispatch(client, params):  # -> list[tuple[str, str]]
+    """Dispatches a 'value' message and waits until its command is done.
+
+    :return: topics and payloads published by the panel
+    """
+    published = []
+
+    def publish(topic, payload=None, qos=0, retain=False, key=None):
+        published.append((topic, payload))
+
+    client.api.publish = publish
+
+    async def drive():
+        assert client.dispatcher.dispatch(
+            topic=TOPIC, payload=dumps({'method': 'value', 'params': params}))
+        while client.api.commands.pending:
+            await asyncio.sleep(0.001)
+
+    asyncio.run(drive())
+    return published
+
+
+def test_bi_read(client):
+    api = client.api
+    api.backend.expanders[BI_BUS].set_input(pin_id=1, level=False)
+    pin = api.routes.pin(bus_id=BI_BUS, pin_id=1)
+    # inverted pins are on at low level
+    value = pin.inverted
+
+    published = dispatch(client, {'device_id': DEVICE_ID,
+                                  'object_type': 3,
+                                  'object_identifier': pin.obj_id})
+    assert published == [(pin.topic, pin.payloads[value])]
+
+
+def test_bo_write(client):
+    api = client.api
+    pin = api.routes.pin(bus_id=BO_BUS, pin_id=2)
+
+    published = dispatch(client, {'device_id': DEVICE_ID,
+                                  'object_type': 4,
+                                  'object_identifier': pin.obj_id,
+                                  'value': 1})
+    assert published == [(pin.topic, pin.payloads[True])]
+    level = api.backend.expanders[BO_BUS].gpio & pin.mask
+    assert bool(level) != pin.inverted
+
+
+def test_bo_write_without_value(client):
+    pin = client.api.routes.pin(bus_id=BO_BUS, pin_id=2)
+
+    published = dispatch(client, {'device_id': DEVICE_ID,
+                                  'object_type': 4,
+                                  'object_identifier': pin.obj_id})
+    [(topic, payload)] = published
+    assert topic == client.error_topic
+    assert loads(payload)['error']['message'] == 'Invalid params: params.value is required'
@@ -0,0 +1,95 @@
+"""Timing of `I2CConnector.start_bus_publishing` on a simulated clock."""
+import asyncio
+import random
+
+import pytest
+
+from mqtt import VisioMQTTClient
+from scheduler import SimulatedClock
+
+BUS_ID = 30
+INTERVAL = 60.0
+INTERVALS = 1000
+
+
+@pytest.fixture
+def api():
+    mqtt_cfg = {'device_id': 666,
+                'host': 'loopback',
+                'port': 1883,
+                'transport': 'loopback',
+                'username': None,
+                'password': None,
+                'subscribe': ['Set/yard/#'],
+                'publish': {BUS_ID: {'interval': INTERVAL,
+                                     'pin_topic': {pin_id: f'Pin/{BUS_ID}/{pin_id}'
+                                                   for pin_id in range(8)},
+                                     }},
+                }
+    i2c_cfg = {'backend': 'simulated',
+               'bi_buses': {BUS_ID: {'realtime_interval': 0.1}},
+               }
+    api = VisioMQTTClient(config=mqtt_cfg, i2c_config=i2c_cfg).api
+    # states come from the last port read by the polling task
+    api._last_ports[BUS_ID] = 0xFF
+    yield api
+    api.io.shutdown()
+
+
+def refreshes_per_interval(api, clock):  # -> list[int]
+    """Runs the publishing task until `INTERVALS` intervals have passed.
+
+    :return: periodic publishes of pin 0 in every interval
+    """
+    pin_topic = api.routes.pin(bus_id=BUS_ID, pin_id=0).topic
+    refreshes = []  # clock time of every periodic publish of pin 0
+
+    def publish(topic, payload=None, qos=0, retain=False, key=None):
+        if topic == pin_topic:
+            refreshes.append(clock())
+
+    api.publish = publish
+    end = INTERVAL * INTERVALS
+
+    async def drive():
+        task = asyncio.create_task(api.start_bus_publishing(
+            bus_id=BUS_ID, mqtt_interval=INTERVAL, start_time=clock(),
+            clock=clock, sleep=clock.sleep))
+        while clock() < end:
+            await asyncio.sleep(0)
+        task.cancel()
+
+    asyncio.run(drive())
+
+    per_interval = [0] * INTERVALS
+    for t in refreshes:
+        if t < end:
+            per_interval[int(t // INTERVAL)] += 1
+    return per_interval
+
+
+def test_one_refresh_per_interval(api):
+    per_interval = refreshes_per_interval(api=api, clock=SimulatedClock())
+    # nothing is due in the first interval
+    assert per_interval[0] == 0
+    assert set(per_interval[1:]) == {1}
+
+
+def test_late_wakeups_and_stall(api):
+    """Sleeps oversleep up to 20% of the interval, one stalls for 3.5 intervals:
+    still at most one refresh per interval, only the 3 stalled intervals
+    have none.
+    """
+    rnd = random.Random(0)
+    stall = {'at': INTERVAL * INTERVALS / 2, 'done': False}
+
+    def lateness(delay):  # -> float
+        if not stall['done'] and clock() + delay >= stall['at']:
+            stall['done'] = True
+            return INTERVAL * 3.5
+        return rnd.uniform(0, INTERVAL * 0.2)
+
+    clock = SimulatedClock(lateness=lateness)
+    per_interval = refreshes_per_interval(api=api, clock=clock)
+    assert max(per_interval) == 1
+    assert per_interval[1:].count(0) == 3